@@ -0,0 +1,115 @@
+import sqlite3
+
+class SQLiteBackend:
+    """
+    Stores jobs in a single SQLite file. This is the default backend; several
+    worker processes on one host can share it.
+    """
+
+    placeholder = "?"
+    blob_type = "BLOB"
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        # Wait on other processes' write locks rather than failing straight away
+        return sqlite3.connect(self.path, timeout=30)
+
+    def sql(self, query):
+        return query
+
+    def claim(self, conn, table_name, condition, params, lease_owner, lease_expires, limit=None):
+        """
+        Leases the first batches matching a condition and returns them.
+
+        UPDATE ... RETURNING needs SQLite 3.35, so the batches are selected and then
+        leased within one transaction that takes the write lock up front, and two
+        workers can't claim the same batch.
+
+        Args:
+            conn: A connection without an open transaction.
+            table_name (str): The name of the table in the database.
+            condition (str): The SQL condition batches must match.
+            params (list): The condition's parameters.
+            lease_owner (str): The name of the claiming worker.
+            lease_expires (float): When the lease runs out.
+            limit (int): The maximum number of batches to claim, or None for all of them.
+
+        Returns:
+            list: The claimed batches as (start, end, attempts) tuples, counting this claim.
+        """
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(
+            f'SELECT rowid, start, "end", attempts FROM {table_name} WHERE {condition} ORDER BY start {"LIMIT ?" if limit is not None else ""}',
+            [*params, limit] if limit is not None else params,
+        )
+        rows = cursor.fetchall()
+        cursor.executemany(
+            f"UPDATE {table_name} SET lease_owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE rowid = ?",
+            [(lease_owner, lease_expires, rowid) for rowid, _, _, _ in rows],
+        )
+        conn.commit()
+        return [(start, end, attempts + 1) for _, start, end, attempts in rows]
+
+class PostgresBackend:
+    """
+    Stores jobs in a PostgreSQL database, so that workers on several hosts can
+    drain the same jobs. Requires the psycopg package.
+    """
+
+    placeholder = "%s"
+    blob_type = "BYTEA"
+
+    def __init__(self, url):
+        try:
+            import psycopg
+        except ImportError as e:
+            raise ImportError("The PostgreSQL store backend requires the 'psycopg' package.") from e
+
+        self._psycopg = psycopg
+        self.url = url
+
+    def connect(self):
+        return self._psycopg.connect(self.url)
+
+    def sql(self, query):
+        # Queries are written with SQLite's '?' placeholders
+        return query.replace("?", self.placeholder)
+
+    def claim(self, conn, table_name, condition, params, lease_owner, lease_expires, limit=None):
+        """
+        Leases the first batches matching a condition and returns them, see
+        `SQLiteBackend.claim`. Rows locked by a concurrent claim are skipped instead
+        of waited on.
+        """
+        cursor = conn.cursor()
+        cursor.execute(self.sql(f"""
+            UPDATE {table_name} SET lease_owner = ?, lease_expires = ?, attempts = attempts + 1
+            WHERE ctid IN (
+                SELECT ctid FROM {table_name} WHERE {condition} ORDER BY start {"LIMIT ?" if limit is not None else ""}
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING start, "end", attempts
+        """), [lease_owner, lease_expires, *params, *([limit] if limit is not None else [])])
+        rows = cursor.fetchall()
+        conn.commit()
+        return rows
+
+def create_backend(database_url, data_dir):
+    """
+    Creates the store backend for a database URL.
+
+    Args:
+        database_url (str): A postgresql:// URL, or None to use SQLite.
+        data_dir (str): The directory holding the SQLite database file.
+
+    Returns:
+        The store backend.
+    """
+    if database_url and database_url.startswith(("postgres://", "postgresql://")):
+        return PostgresBackend(database_url)
+    if database_url and database_url.startswith("sqlite:///"):
+        return SQLiteBackend(database_url[len("sqlite:///"):])
+    return SQLiteBackend(f"{data_dir}/app.db")
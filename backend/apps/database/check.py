@@ -0,0 +1,116 @@
+import argparse
+import os
+import threading
+import time
+
+from backend.apps.database import main as database
+from backend.apps.database.backends import create_backend
+
+def expect(condition, message):
+    """
+    Raises a RuntimeError with the message unless the condition holds.
+    """
+    if not condition:
+        raise RuntimeError(message)
+
+def check_backend(database_url=None, workers=4):
+    """
+    Runs a job through a store backend end to end: creating its tables, claiming its
+    batches from several workers at once, writing and reading them back, syncing its
+    budget and caching its spans. The job's tables and cache entries are removed afterwards.
+
+    Args:
+        database_url (str): The database to check, e.g. postgresql://localhost/nexgen,
+            or None for the configured backend.
+        workers (int): The number of workers claiming batches concurrently.
+
+    Raises:
+        RuntimeError: If the backend misbehaves.
+    """
+    if database_url:
+        database._backend = create_backend(database_url, database.DATA_DIR)
+
+    table_name = f"store_check_{os.getpid()}_{int(time.time())}"
+    total_characters = 50
+    raw_characters = "".join(f"{number}. Character {number} – ünïcode: absent (0); present (1).\n" for number in range(1, total_characters + 1))
+    token_report = database.initialize_database(table_name, raw_characters, total_characters, "#NEXUS")
+
+    try:
+        # Workers claim two batches at a time until none are left, no batch may be claimed twice
+        claims = [[] for _ in range(workers)]
+        errors = []
+        def drain(worker):
+            try:
+                while batches := database.claim_batches(table_name, f"check-{worker}", max_attempts=1, limit=2):
+                    claims[worker].extend(batch["start"] for batch in batches)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=drain, args=(worker,)) for worker in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise RuntimeError(f"Claiming batches failed: {errors[0]!r}") from errors[0]
+
+        claimed = sorted(start for worker_claims in claims for start in worker_claims)
+        expect(claimed == [batch["start"] for batch in database.identify_invalid_batches(table_name)], f"Batches claimed twice or never: {claimed}")
+        expect(len(claimed) == token_report["total_batches"], f"Claimed {len(claimed)} of {token_report['total_batches']} batches.")
+        expect(database.count_leased_batches(table_name) == token_report["total_batches"], "Claimed batches aren't counted as leased.")
+
+        database.renew_leases(table_name, "check-0")
+        database.release_batches(table_name, "check-0", [{"start": start} for start in claims[0]])
+        for worker in range(1, workers):
+            database.release_batches(table_name, f"check-{worker}")
+        expect(database.count_leased_batches(table_name) == 0, "Released batches are still leased.")
+        expect(database.claim_batches(table_name, "check-0", max_attempts=1) == [], "Batches were claimed beyond max_attempts.")
+
+        # Write each batch back and read it again
+        batches = database.identify_invalid_batches(table_name)
+        contexts = database.read_database(table_name, batches, column_name="context")
+        xml_list = [
+            ("<characters>" + "".join(f'<character index="{number}" name="Character {number}"><state value="0">absent</state></character>' for number in range(batch["start"], batch["end"] + 1)) + "</characters>").encode("utf-8")
+            for batch in batches
+        ]
+        expect(all(f"{batch['start']}. Character" in context for batch, context in zip(batches, contexts)), "Contexts don't round-trip.")
+        database.update_database(table_name, batches, xml_list, column_name="xml_characters")
+        database.update_database(table_name, batches, [1] * len(batches), column_name="validation_status")
+        database.update_database(table_name, batches, [1] * len(batches), column_name="evaluation_status")
+
+        expect(database.identify_invalid_batches(table_name) == [], "Completed batches are still incomplete.")
+        expect(database.count_batches(table_name) == (len(batches), len(batches)), "Completed batches aren't counted.")
+        labels = [int(character.attrib["index"]) for character in database.get_labels(table_name)]
+        expect(labels == list(range(1, total_characters + 1)), f"Labels don't round-trip: {labels}")
+        expect(database.read_nexus(table_name) == "#NEXUS", "The NEXUS content doesn't round-trip.")
+
+        # Spending adds up across workers and a cancellation sticks
+        database.sync_job_budget(table_name, 10, 0.5, False)
+        job_budget = database.sync_job_budget(table_name, 5, 0.25, True)
+        database.sync_job_budget(table_name, 0, 0.0, False)
+        expect((job_budget["tokens_used"], job_budget["cost"], job_budget["cancelled"]) == (15, 0.75, True), f"The budget doesn't add up: {job_budget}")
+        expect(database.sync_job_budget(table_name, 0, 0.0, False)["cancelled"], "The cancellation didn't stick.")
+
+        # Caching twice exercises the upsert
+        database.cache_extracted_spans(table_name)
+        database.cache_extracted_spans(table_name)
+    finally:
+        store = database.get_backend()
+        conn = store.connect()
+        cursor = conn.cursor()
+        cursor.execute(f"DELETE FROM span_cache WHERE fingerprint IN (SELECT fingerprint FROM {table_name}_spans)")
+        conn.commit()
+        conn.close()
+        database.drop_job(table_name)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a store backend, e.g. against a local PostgreSQL instance.")
+    parser.add_argument("database_url", nargs="?", default=database.DATABASE_URL, help="The database URL, SQLite in DATA_DIR by default.")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    check_backend(args.database_url, args.workers)
+    print(f"{type(database.get_backend()).__name__} passed.")
+
+if __name__ == "__main__":
+    main()
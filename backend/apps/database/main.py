@@ -3,59 +3,287 @@ sys.path.append('../backend')
 
 import sqlite3
 import os
+import time
+from collections.abc import Sequence
 from lxml import etree
 
-from backend.apps.retriever.main import retrieve_context
+from backend.apps.retriever.main import retrieve_context_bounds, retrieve_fallback_bounds, locate_character_spans, fingerprint_span, estimate_tokens, BlockIndex, MAX_CONTEXT_TOKENS
+from backend.apps.database.backends import create_backend
 from backend.static.prompt_template import generative_prompt
 
-DATA_DIR = os.path.dirname(__file__) + "/../../data"
+DATA_DIR = os.environ.get("NEXGEN_DATA_DIR", os.path.dirname(__file__) + "/../../data")
 BATCH_SIZE = 10
 
-def initialize_database(table_name, raw_characters, total_characters):
+# Set to a postgresql:// URL to share jobs between hosts, SQLite in DATA_DIR is used otherwise
+DATABASE_URL = os.environ.get("NEXGEN_DATABASE_URL")
+
+# How long a worker may hold claimed batches before other workers can take them over, in seconds
+LEASE_SECONDS = 600
+
+# Batches still to be extracted
+INCOMPLETE_CONDITION = "(validation_status != 1 OR evaluation_status != 1 OR xml_characters IS NULL OR xml_characters = '')"
+
+_backend = None
+
+def get_backend():
+    """
+    Returns the store backend, created from NEXGEN_DATABASE_URL on first use.
     """
-    Creates a table with the specified name in the SQLite database,
+    global _backend
+    if _backend is None:
+        _backend = create_backend(DATABASE_URL, DATA_DIR)
+    return _backend
+
+def initialize_database(table_name, raw_characters, total_characters, nexus_content=None, max_context_tokens=MAX_CONTEXT_TOKENS, budget=None):
+    """
+    Creates a table with the specified name in the store database,
     emptying it if it already exists.
 
+    The document text is stored once per job in a companion table, and each
+    batch only records the byte offset and length of its context within it.
+
+    Characters whose source span is unchanged since an earlier extraction are
+    filled in from the span cache and marked complete, and the remaining
+    characters are grouped into batches for the language model.
+
     Args:
         table_name (str): The name of the table to create or empty.
+        raw_characters (str): The extracted text of the character list.
+        total_characters (int): The number of characters to extract.
+        nexus_content (str): The content of the uploaded NEXUS file, stored so that
+            workers in other processes can check the states against its MATRIX.
+        max_context_tokens (int): The maximum size of each batch's context in estimated tokens.
+        budget (JobBudget): The job's limits, stored so that workers in other processes
+            stop at the same deadline and spending caps, see `sync_job_budget`.
+
+    Returns:
+        dict: The estimated 'context_tokens' stored for the job, the
+        'fixed_window_tokens' the same batches would have used with fixed padding
+        the number of 'reused_characters' taken from the span cache, the number
+        of 'fallback_batches' located through the block index and the number of
+        'total_batches' in the job.
     """
-    conn = sqlite3.connect(f"{DATA_DIR}/app.db")  # Connect to the database
+    store = get_backend()
+    conn = store.connect()  # Connect to the database
     cursor = conn.cursor()
 
-    # Drop the table if it already exists
+    # Drop the tables if they already exist
     cursor.execute(f"DROP TABLE IF EXISTS {table_name};")
+    cursor.execute(f"DROP TABLE IF EXISTS {table_name}_document;")
+    cursor.execute(f"DROP TABLE IF EXISTS {table_name}_spans;")
 
-    # Create the table
+    # Create the tables
+    cursor.execute(f"""
+        CREATE TABLE {table_name}_document (
+            content {store.blob_type},
+            nexus TEXT,
+            deadline DOUBLE PRECISION,
+            max_tokens INTEGER,
+            max_cost DOUBLE PRECISION,
+            tokens_used INTEGER DEFAULT 0,
+            cost DOUBLE PRECISION DEFAULT 0,
+            cancelled INTEGER DEFAULT 0
+        );
+    """)
+    cursor.execute(f"CREATE TABLE {table_name}_spans (number INTEGER PRIMARY KEY, fingerprint TEXT);")
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS span_cache (fingerprint TEXT PRIMARY KEY, xml_character {store.blob_type});")
     cursor.execute(f"""
         CREATE TABLE {table_name} (
             start INTEGER,
-            end INTEGER,
-            context TEXT,
+            "end" INTEGER,
+            context_offset INTEGER,
+            context_length INTEGER,
             prompt TEXT,
-            xml_characters BLOB,
-            validation_status BOOLEAN DEFAULT FALSE,
-            evaluation_status BOOLEAN DEFAULT FALSE
+            xml_characters {store.blob_type},
+            validation_status INTEGER DEFAULT 0,
+            evaluation_status INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires DOUBLE PRECISION
         );
     """)
 
+    cursor.execute(
+        store.sql(f"INSERT INTO {table_name}_document (content, nexus, deadline, max_tokens, max_cost) VALUES (?, ?, ?, ?, ?)"),
+        (raw_characters.encode("utf-8"), nexus_content, *((budget.deadline, budget.max_tokens, budget.max_cost) if budget else (None, None, None))),
+    )
+
+    # Fingerprint each character's source span and look up earlier extractions of it
+    character_spans = locate_character_spans(raw_characters, total_characters)
+    fingerprints = {
+        number: fingerprint_span(raw_characters[span_start:span_end], number)
+        for number, (span_start, span_end) in character_spans.items()
+    }
+    cursor.executemany(store.sql(f"INSERT INTO {table_name}_spans (number, fingerprint) VALUES (?, ?)"), list(fingerprints.items()))
+
+    cached = _read_span_cache(store, cursor, list(fingerprints.values()))
+    reused = {number: cached[fingerprint] for number, fingerprint in fingerprints.items() if fingerprint in cached}
+
+    token_report = {"context_tokens": 0, "fixed_window_tokens": 0, "reused_characters": len(reused), "fallback_batches": 0}
+
+    # Build on first use, once per document
+    block_index = None
+
+    # Group consecutive characters that are either all reused or all new into batches
+    batches = []
     start = 1
     while start <= total_characters:
-        end = min(start + BATCH_SIZE - 1, total_characters)
+        is_reused = start in reused
+        end = start
+        while end < total_characters and end - start + 1 < BATCH_SIZE and ((end + 1) in reused) == is_reused:
+            end += 1
 
-        context = retrieve_context(raw_characters, start, end)
         prompt = generative_prompt.format(start=start, end=end)
-
-        cursor.execute(f"""
-            INSERT INTO {table_name} (start, end, context, prompt)
-            VALUES (?, ?, ?, ?)
-        """, (start, end, context, prompt))
-        conn.commit()
+        if is_reused:
+            xml_characters = b"<characters>" + b"".join(reused[number] for number in range(start, end + 1)) + b"</characters>"
+            batches.append((start, end, (0, 0), prompt, xml_characters, 1))
+        else:
+            bounds = retrieve_context_bounds(raw_characters, start, end, max_context_tokens, token_report=token_report)
+            if bounds is None:
+                # Fall back to the document's blocks when the numbering can't be followed
+                block_index = block_index if block_index is not None else BlockIndex(raw_characters)
+                bounds = retrieve_fallback_bounds(raw_characters, block_index, start, end, total_characters, character_spans, max_context_tokens) or (0, 0)
+                # Fixed padding has no window for these batches, so they count the same on both sides
+                fallback_tokens = estimate_tokens(bounds[1] - bounds[0])
+                token_report["context_tokens"] += fallback_tokens
+                token_report["fixed_window_tokens"] += fallback_tokens
+                token_report["fallback_batches"] += 1
+            batches.append((start, end, bounds, prompt, None, 0))
 
         start = end + 1
 
+    token_report["total_batches"] = len(batches)
+
+    byte_offsets = _char_to_byte_offsets(raw_characters, [offset for batch in batches for offset in batch[2]])
+
+    cursor.executemany(store.sql(f"""
+        INSERT INTO {table_name} (start, "end", context_offset, context_length, prompt, xml_characters, validation_status, evaluation_status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """), [
+        (start, end, byte_offsets[bounds[0]], byte_offsets[bounds[1]] - byte_offsets[bounds[0]], prompt, xml_characters, status, status)
+        for start, end, bounds, prompt, xml_characters, status in batches
+    ])
+
     conn.commit()
     conn.close()  # Close the connection to the database
 
+    return token_report
+
+def drop_job(table_name):
+    """
+    Deletes a job's tables, including its copy of the document. The span cache is kept.
+
+    Args:
+        table_name (str): The name of the job's table.
+    """
+    conn = get_backend().connect()
+    cursor = conn.cursor()
+
+    for suffix in ("", "_document", "_spans"):
+        cursor.execute(f"DROP TABLE IF EXISTS {table_name}{suffix};")
+
+    conn.commit()
+    conn.close()
+
+def _read_span_cache(store, cursor, fingerprints, chunk_size=500):
+    """
+    Fetches the cached extractions of the given span fingerprints.
+
+    Args:
+        store: The store backend.
+        cursor: An open database cursor.
+        fingerprints (list): The span fingerprints to look up.
+        chunk_size (int): The number of fingerprints per query, below SQLite's variable limit.
+
+    Returns:
+        dict: A mapping from each cached fingerprint to its XML character element.
+    """
+    cached = {}
+    for i in range(0, len(fingerprints), chunk_size):
+        chunk = fingerprints[i:i + chunk_size]
+        cursor.execute(store.sql(f"""
+            SELECT fingerprint, xml_character FROM span_cache
+            WHERE xml_character IS NOT NULL AND fingerprint IN ({", ".join("?" * len(chunk))})
+        """), chunk)
+        cached.update(cursor.fetchall())
+    return cached
+
+def cache_extracted_spans(table_name):
+    """
+    Stores each character of the completed batches in the span cache, keyed by
+    the fingerprint of its source span, so that later versions of the document
+    can reuse them.
+
+    Args:
+        table_name (str): The name of the table in the database.
+    """
+    store = get_backend()
+    conn = store.connect()
+    cursor = conn.cursor()
+
+    cursor.execute(f"SELECT number, fingerprint FROM {table_name}_spans")
+    fingerprints = dict(cursor.fetchall())
+
+    cursor.execute(f"""
+        SELECT xml_characters FROM {table_name}
+        WHERE validation_status = 1 AND evaluation_status = 1 AND xml_characters IS NOT NULL AND xml_characters <> ''
+    """)
+
+    entries = []
+    for row in cursor.fetchall():
+        for character in etree.fromstring(row[0]).iter('character'):
+            fingerprint = fingerprints.get(int(character.attrib['index']))
+            if fingerprint:
+                entries.append((fingerprint, etree.tostring(character, with_tail=False)))
+
+    cursor.executemany(store.sql("""
+        INSERT INTO span_cache (fingerprint, xml_character) VALUES (?, ?)
+        ON CONFLICT (fingerprint) DO UPDATE SET xml_character = excluded.xml_character
+    """), entries)
+
+    conn.commit()
+    conn.close()
+
+def _char_to_byte_offsets(text, offsets):
+    """
+    Maps character offsets in a text to byte offsets in its UTF-8 encoding in a single pass.
+
+    Args:
+        text (str): The text the offsets refer to.
+        offsets (list): The character offsets to map.
+
+    Returns:
+        dict: A mapping from each character offset to its byte offset.
+    """
+    byte_offsets = {}
+    char_position = 0
+    byte_position = 0
+    for offset in sorted(set(offsets)):
+        byte_position += len(text[char_position:offset].encode("utf-8"))
+        char_position = offset
+        byte_offsets[offset] = byte_position
+    return byte_offsets
+
+class DocumentSlices(Sequence):
+    """
+    A read-only sequence of batch contexts backed by a single copy of the document.
+
+    Contexts are sliced out of a memoryview of the UTF-8 document and only decoded
+    when they are accessed.
+    """
+
+    def __init__(self, document, spans):
+        self._document = memoryview(document)
+        self._spans = spans
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        offset, length = self._spans[index]
+        return str(self._document[offset:offset + length], "utf-8")
 
 def identify_invalid_batches(table_name):
     """
@@ -69,13 +297,14 @@ def identify_invalid_batches(table_name):
         list: A list of question IDs with validation status False or empty "xml_characters" entries.
     """
     characters_dict = []
-    conn = sqlite3.connect(f"{DATA_DIR}/app.db")  # Connect to the SQLite database
+    conn = get_backend().connect()  # Connect to the database
 
     cursor = conn.cursor()
     cursor.execute(f"""
-        SELECT start, end, xml_characters
+        SELECT start, "end", xml_characters
         FROM {table_name}
-        WHERE validation_status != 1 OR evaluation_status != 1 OR xml_characters IS NULL OR xml_characters = '';
+        WHERE {INCOMPLETE_CONDITION}
+        ORDER BY start;
     """)
 
     for row in cursor.fetchall():
@@ -87,8 +316,9 @@ def identify_invalid_batches(table_name):
     return characters_dict
 
 def update_database(table_name, column_dict, data_list, column_name):
-    # Connect to the SQLite database
-    conn = sqlite3.connect(f"{DATA_DIR}/app.db")
+    # Connect to the database
+    store = get_backend()
+    conn = store.connect()
     cursor = conn.cursor()
 
     # Iterate over the dictionaries and xml_list
@@ -101,7 +331,7 @@ def update_database(table_name, column_dict, data_list, column_name):
         xml_character = data_list[i]
 
         # Update the row in the table
-        cursor.execute(f"UPDATE {table_name} SET {column_name} = ? WHERE start = ? AND end = ?", (xml_character, start, end))
+        cursor.execute(store.sql(f'UPDATE {table_name} SET {column_name} = ? WHERE start = ? AND "end" = ?'), (xml_character, start, end))
 
     # Commit the changes and close the connection
     conn.commit()
@@ -110,10 +340,24 @@ def update_database(table_name, column_dict, data_list, column_name):
 import sqlite3
 
 def read_database(table_name, column_dicts, column_name):
-    # Connect to the SQLite database
-    conn = sqlite3.connect(f"{DATA_DIR}/app.db")
+    # Connect to the database
+    store = get_backend()
+    conn = store.connect()
     cursor = conn.cursor()
 
+    # Contexts are sliced lazily out of the job's single stored document
+    if column_name == "context":
+        cursor.execute(f"SELECT content FROM {table_name}_document")
+        document = cursor.fetchone()[0]
+
+        spans = []
+        for column_dict in column_dicts:
+            cursor.execute(store.sql(f'SELECT context_offset, context_length FROM {table_name} WHERE start = ? AND "end" = ?'), (column_dict['start'], column_dict['end']))
+            spans.extend(cursor.fetchall())
+
+        conn.close()
+        return DocumentSlices(document, spans)
+
     # Prepare a list to hold all the values
     all_values = []
 
@@ -124,7 +368,7 @@ def read_database(table_name, column_dicts, column_name):
         end = column_dict['end']
 
         # Execute the SELECT statement
-        cursor.execute(f"SELECT {column_name} FROM {table_name} WHERE start = ? AND end = ?", (start, end))
+        cursor.execute(store.sql(f'SELECT {column_name} FROM {table_name} WHERE start = ? AND "end" = ?'), (start, end))
 
         # Fetch all the rows
         rows = cursor.fetchall()
@@ -140,15 +384,15 @@ def read_database(table_name, column_dicts, column_name):
 
 def get_labels(table_name, column_name='xml_characters'):
 
-    # Connect to the SQLite database
-    conn = sqlite3.connect(f"{DATA_DIR}/app.db")
+    # Connect to the database
+    conn = get_backend().connect()
     cursor = conn.cursor()
 
     # Prepare a list to hold all the values
     all_values = etree.Element('characters')
 
     # Use parameterized query to prevent SQL injection
-    cursor.execute(f"SELECT {column_name} FROM {table_name} WHERE {column_name} IS NOT NULL AND {column_name} <> ''")
+    cursor.execute(f"SELECT {column_name} FROM {table_name} WHERE {column_name} IS NOT NULL AND {column_name} <> '' ORDER BY start")
     
     rows = cursor.fetchall()
 
@@ -164,4 +408,171 @@ def get_labels(table_name, column_name='xml_characters'):
     conn.close()
 
     # Return the list of values from the specified column
-    return all_values
\ No newline at end of file
+    return all_values
+
+def claim_batches(table_name, worker_id, max_attempts, limit=None, lease_seconds=LEASE_SECONDS):
+    """
+    Leases incomplete batches to a worker, so that several workers can drain the
+    same job without extracting a batch twice.
+
+    Batches leased by another worker are skipped until that lease expires, and a
+    batch is no longer handed out once it has been claimed max_attempts times.
+
+    Args:
+        table_name (str): The name of the table in the database.
+        worker_id (str): A name unique to the claiming worker.
+        max_attempts (int): The number of times a batch may be claimed.
+        limit (int): The maximum number of batches to claim, or None for all of them.
+        lease_seconds (float): How long the worker may hold the batches.
+
+    Returns:
+        list: The claimed batches as dictionaries with 'start', 'end' and 'attempt' keys.
+    """
+    store = get_backend()
+    conn = store.connect()
+
+    now = time.time()
+    condition = f"{INCOMPLETE_CONDITION} AND attempts < ? AND (lease_expires IS NULL OR lease_expires < ?)"
+    rows = store.claim(conn, table_name, condition, [max_attempts, now], worker_id, now + lease_seconds, limit)
+    batches = [{"start": row[0], "end": row[1], "attempt": row[2]} for row in rows]
+
+    conn.close()
+
+    return sorted(batches, key=lambda batch: batch["start"])
+
+def release_batches(table_name, worker_id, column_dicts=None):
+    """
+    Releases batches leased by a worker, so that the ones it left incomplete can
+    be claimed again straight away.
+
+    Args:
+        table_name (str): The name of the table in the database.
+        worker_id (str): The name the worker claimed the batches with.
+        column_dicts (list): The batches to release, or None for all of the worker's batches.
+    """
+    store = get_backend()
+    conn = store.connect()
+    cursor = conn.cursor()
+
+    if column_dicts is None:
+        cursor.execute(store.sql(f"UPDATE {table_name} SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = ?"), (worker_id,))
+    else:
+        cursor.executemany(
+            store.sql(f"UPDATE {table_name} SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = ? AND start = ?"),
+            [(worker_id, column_dict['start']) for column_dict in column_dicts],
+        )
+
+    conn.commit()
+    conn.close()
+
+def renew_leases(table_name, worker_id, lease_seconds=LEASE_SECONDS):
+    """
+    Extends the leases a worker holds, so that batches still being extracted
+    aren't taken over by other workers.
+
+    Args:
+        table_name (str): The name of the table in the database.
+        worker_id (str): The name the worker claimed the batches with.
+        lease_seconds (float): How long from now the worker may hold the batches.
+    """
+    store = get_backend()
+    conn = store.connect()
+    cursor = conn.cursor()
+
+    cursor.execute(store.sql(f"UPDATE {table_name} SET lease_expires = ? WHERE lease_owner = ?"), (time.time() + lease_seconds, worker_id))
+
+    conn.commit()
+    conn.close()
+
+def count_leased_batches(table_name):
+    """
+    Counts the incomplete batches currently leased by any worker.
+
+    Args:
+        table_name (str): The name of the table in the database.
+
+    Returns:
+        int: The number of leased batches.
+    """
+    store = get_backend()
+    conn = store.connect()
+    cursor = conn.cursor()
+
+    cursor.execute(store.sql(f"SELECT COUNT(*) FROM {table_name} WHERE {INCOMPLETE_CONDITION} AND lease_expires >= ?"), (time.time(),))
+    count = cursor.fetchone()[0]
+
+    conn.close()
+
+    return count
+
+def count_batches(table_name):
+    """
+    Counts a job's completed and total batches.
+
+    Args:
+        table_name (str): The name of the table in the database.
+
+    Returns:
+        tuple: The number of completed batches and the total number of batches.
+    """
+    conn = get_backend().connect()
+    cursor = conn.cursor()
+
+    cursor.execute(f"SELECT COUNT(*), SUM(CASE WHEN {INCOMPLETE_CONDITION} THEN 0 ELSE 1 END) FROM {table_name}")
+    total, completed = cursor.fetchone()
+
+    conn.close()
+
+    return completed or 0, total
+
+def read_nexus(table_name):
+    """
+    Fetches the NEXUS file content stored with a job.
+
+    Args:
+        table_name (str): The name of the table in the database.
+
+    Returns:
+        str: The content of the NEXUS file, or None if the job was created without one.
+    """
+    conn = get_backend().connect()
+    cursor = conn.cursor()
+
+    cursor.execute(f"SELECT nexus FROM {table_name}_document")
+    nexus_content = cursor.fetchone()[0]
+
+    conn.close()
+
+    return nexus_content
+
+def sync_job_budget(table_name, tokens, cost, cancelled):
+    """
+    Adds a worker's spending since its last sync to the job's totals and reads back
+    the job's limits, so that every worker draining the job stops together.
+
+    Args:
+        table_name (str): The name of the table in the database.
+        tokens (int): The tokens the worker spent since its last sync.
+        cost (float): The cost the worker incurred since its last sync.
+        cancelled (bool): Whether the worker's job was cancelled. Once any worker
+            reports a cancellation, the job stays cancelled.
+
+    Returns:
+        dict: The job's 'deadline', 'max_tokens' and 'max_cost', each None if not
+        enforced, the 'tokens_used' and 'cost' of all workers, and whether it is 'cancelled'.
+    """
+    store = get_backend()
+    conn = store.connect()
+    cursor = conn.cursor()
+
+    cursor.execute(
+        store.sql(f"UPDATE {table_name}_document SET tokens_used = tokens_used + ?, cost = cost + ?, cancelled = CASE WHEN ? = 1 THEN 1 ELSE cancelled END"),
+        (tokens, cost, int(cancelled)),
+    )
+    cursor.execute(f"SELECT deadline, max_tokens, max_cost, tokens_used, cost, cancelled FROM {table_name}_document")
+    deadline, max_tokens, max_cost, tokens_used, total_cost, job_cancelled = cursor.fetchone()
+
+    conn.commit()
+    conn.close()
+
+    return {"deadline": deadline, "max_tokens": max_tokens, "max_cost": max_cost, "tokens_used": tokens_used, "cost": total_cost, "cancelled": bool(job_cancelled)}
@@ -1,13 +1,15 @@
 from backend.apps.doc.utils import convert_doc_to_markdown
+from backend.apps.doc.utils import convert_docx_to_text
 from backend.apps.doc.utils import get_page_range
 
-def convert_document(uploaded_file, target_pages):
+def convert_document(uploaded_file, target_pages, unit="page"):
 
     """Converts an uploaded document to markdown.
 
     Args:
-        uploaded_file: The uploaded PDF file object.
+        uploaded_file: The uploaded PDF or DOCX file object.
         page_range: The desired page range (e.g., '1-10', '5,12', '10').
+        unit: For DOCX files, whether the range refers to "page" or "section" numbers.
 
     Returns:
         The converted markdown text or None if an error occurred.
@@ -15,6 +17,9 @@ def convert_document(uploaded_file, target_pages):
 
     pages_list = get_page_range(target_pages)
 
-    converted_document = convert_doc_to_markdown(uploaded_file, pages_list)
+    if uploaded_file.name.lower().endswith(".docx"):
+        converted_document = convert_docx_to_text(uploaded_file, pages_list, unit)
+    else:
+        converted_document = convert_doc_to_markdown(uploaded_file, pages_list)
 
     return converted_document
@@ -1,6 +1,11 @@
 import pymupdf4llm
 import fitz
 import re
+import zipfile
+from lxml import etree
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+MARKUP_COMPATIBILITY_NAMESPACE = "{http://schemas.openxmlformats.org/markup-compatibility/2006}"
 
 def convert_doc_to_markdown(uploaded_file, pages_list):
     """Converts a uploaded document to markdown.
@@ -40,6 +45,90 @@ def convert_doc_to_markdown(uploaded_file, pages_list):
     except Exception as e:
         raise(f"Error parsing document: {e}")
 
+def convert_docx_to_text(uploaded_file, pages_list, unit="page"):
+    """Converts an uploaded Word document to plain text by streaming its XML.
+
+    `word/document.xml` is read with an incremental parser and each paragraph is
+    discarded once its text is emitted, so memory stays flat on long documents.
+    Pages are counted from explicit and last rendered page breaks, sections from
+    section breaks. Paragraphs nested in text boxes are emitted as lines of their
+    own, and the `mc:Fallback` copies Word keeps of text boxes are skipped.
+
+    Args:
+        uploaded_file: The uploaded DOCX file object.
+        pages_list: The desired zero-based pages or sections (e.g., [0, 1, 2]).
+        unit: Whether pages_list refers to "page" or "section" numbers.
+
+    Returns:
+        The extracted text, one paragraph per line.
+    """
+
+    paragraph_tag = WORD_NAMESPACE + "p"
+    fallback_tag = MARKUP_COMPATIBILITY_NAMESPACE + "Fallback"
+    targets = set(pages_list)
+    last_target = max(targets)
+
+    page = 0
+    section = 0
+    page_has_text = False
+    text = []
+
+    with zipfile.ZipFile(uploaded_file) as docx, docx.open("word/document.xml") as document_xml:
+        # One text buffer per open paragraph, as text boxes nest paragraphs in paragraphs
+        paragraphs = []
+        fallback_depth = 0
+        for event, element in etree.iterparse(document_xml, events=("start", "end")):
+            tag = element.tag
+
+            # Skip the fallback copy of content Word also stores in mc:Choice
+            if tag == fallback_tag:
+                fallback_depth += 1 if event == "start" else -1
+                if event == "end":
+                    element.clear()
+                continue
+            if fallback_depth:
+                continue
+
+            if event == "start":
+                if tag == paragraph_tag:
+                    paragraphs.append([])
+                elif tag == WORD_NAMESPACE + "lastRenderedPageBreak" or (tag == WORD_NAMESPACE + "br" and element.get(WORD_NAMESPACE + "type") == "page"):
+                    # Consecutive breaks without text in between start a single new page
+                    if page_has_text:
+                        page += 1
+                        page_has_text = False
+                continue
+
+            if not paragraphs:
+                continue
+
+            if tag == WORD_NAMESPACE + "t":
+                paragraphs[-1].append(element.text or "")
+            elif tag == WORD_NAMESPACE + "tab":
+                paragraphs[-1].append("\t")
+            elif tag == WORD_NAMESPACE + "br" and element.get(WORD_NAMESPACE + "type") != "page":
+                paragraphs[-1].append("\n")
+            elif tag == paragraph_tag:
+                paragraph_text = "".join(paragraphs.pop()).strip()
+                if paragraph_text:
+                    page_has_text = True
+                    if (page if unit == "page" else section) in targets:
+                        text.append(paragraph_text + "\n")
+
+                # A section break is stored in the properties of the section's last paragraph
+                if element.find(f"{WORD_NAMESPACE}pPr/{WORD_NAMESPACE}sectPr") is not None:
+                    section += 1
+
+                # Free the paragraph and everything parsed before it
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+                if (page if unit == "page" else section) > last_target:
+                    break
+
+    return "".join(text)
+
 def get_page_range(page_range_str):
     """Validates a page range string with flexible formatting and returns a list of pages.
 
@@ -0,0 +1,293 @@
+import bisect
+import re
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+
+from lxml import etree
+
+SHINGLE_SIZE = 2
+MAX_CANDIDATES = 5
+GROUNDING_THRESHOLD = 0.85
+
+def find_tokens(text):
+    """
+    Finds the lowercase word tokens of a text and where they are, rejoining words
+    hyphenated across line breaks.
+
+    Args:
+        text: The text to tokenize.
+
+    Returns:
+        A tuple of the text with hyphenated words rejoined, its word tokens and the start
+        and end index of each token in that text.
+    """
+
+    text = re.sub(r"-\s*\n\s*", "", text)
+    matches = list(re.finditer(r"\w+", text))
+    return text, [match.group().lower() for match in matches], [match.span() for match in matches]
+
+def tokenize(text):
+    """
+    Splits text into lowercase word tokens, see `find_tokens`.
+
+    Args:
+        text: The text to tokenize.
+
+    Returns:
+        A list of word tokens.
+    """
+
+    return find_tokens(text)[1]
+
+def build_shingle_index(tokens, shingle_size=SHINGLE_SIZE):
+    """
+    Builds an inverted index from word shingles to their positions in a token list.
+
+    Single words are indexed as well, so that short texts can be located.
+
+    Args:
+        tokens: The word tokens of the context.
+        shingle_size: The number of consecutive words in each shingle.
+
+    Returns:
+        A dictionary mapping each shingle (a tuple of words) to the list of positions where it starts.
+    """
+
+    index = defaultdict(list)
+    for size in {1, shingle_size}:
+        for position in range(len(tokens) - size + 1):
+            index[tuple(tokens[position:position + size])].append(position)
+    return index
+
+def locate_match(text, context_tokens, index, shingle_size=SHINGLE_SIZE):
+    """
+    Finds where a text best appears in the context and scores the match, from 0 (absent) to 1 (verbatim).
+
+    Candidate locations are found through the shingle index and scored by the share of
+    the text's words that appear there in order, so small differences such as OCR
+    errors lower the score instead of failing the match outright. Texts without any
+    words, such as empty or '?' labels, can't be checked and score 0.
+
+    Args:
+        text: The extracted text to look up.
+        context_tokens: The word tokens of the context.
+        index: The shingle index from `build_shingle_index`.
+        shingle_size: The number of consecutive words in each shingle.
+
+    Returns:
+        A tuple of the best share of matched words found and the positions of the first
+        and last matched context tokens, or None for both if nothing matched.
+    """
+
+    query = tokenize(text)
+    if not query:
+        return 0.0, None, None
+
+    size = min(shingle_size, len(query))
+
+    # Each shingle hit votes for the context position where the text would start
+    votes = Counter()
+    for offset in range(len(query) - size + 1):
+        for position in index.get(tuple(query[offset:offset + size]), ()):
+            votes[position - offset] += 1
+
+    best = (0.0, None, None)
+    for start, _ in votes.most_common(MAX_CANDIDATES):
+        # Allow the source to interleave extra words, e.g. inline state codes
+        window_start = max(0, start)
+        window = context_tokens[window_start:window_start + 2 * len(query)]
+        matcher = SequenceMatcher(None, query, window, autojunk=False)
+        blocks = [block for block in matcher.get_matching_blocks() if block.size]
+        score = sum(block.size for block in blocks) / len(query)
+        if score > best[0]:
+            best = (score, window_start + blocks[0].b, window_start + blocks[-1].b + blocks[-1].size - 1)
+        if best[0] == 1.0:
+            break
+
+    return best
+
+def match_score(text, context_tokens, index, shingle_size=SHINGLE_SIZE):
+    """
+    Scores how closely a text appears in the context, see `locate_match`.
+
+    Returns:
+        float: The best share of matched words found.
+    """
+
+    return locate_match(text, context_tokens, index, shingle_size)[0]
+
+def check_state_codes(states, context_tokens):
+    """
+    Checks that each state's code sits next to its label in the context.
+
+    Character lists write a state's code either just before its label, e.g. '0 = absent',
+    or just after it, e.g. 'absent (0)'. The side the batch's codes fit best is taken as
+    the document's convention; swapped codes fit neither side and fail. Contexts where
+    most labels have no number next to them are not checked.
+
+    Args:
+        states: A list of tuples of each state's code and the positions of the first and
+            last context tokens its label matched, or None if it didn't match.
+        context_tokens: The word tokens of the context.
+
+    Returns:
+        A list with 1.0 for each state whose code matches and 0.0 for the others, or None if
+        the context doesn't code states next to their labels.
+    """
+
+    neighbours = {"before": [], "after": []}
+    for value, first, last in states:
+        if first is None:
+            neighbours["before"].append(None)
+            neighbours["after"].append(None)
+            continue
+        neighbours["before"].append(context_tokens[first - 1] if first > 0 else None)
+        neighbours["after"].append(context_tokens[last + 1] if last + 1 < len(context_tokens) else None)
+
+    # A side codes the states if most labels have a number there, not just the odd character number
+    matched = sum(1 for _, first, _ in states if first is not None)
+    coded_sides = [side for side, tokens in neighbours.items() if sum(1 for token in tokens if token and token.isdigit()) * 2 > matched]
+    if not coded_sides:
+        return None
+
+    matches = {
+        side: [1.0 if token == value.lower() else 0.0 for token, (value, _, _) in zip(neighbours[side], states)]
+        for side in coded_sides
+    }
+    return max(matches.values(), key=sum)
+
+# A state code written next to its label, e.g. '(0)', '[1]', '0 =' or '1:'
+CODE_PATTERN = re.compile(r"[(\[]\s*(\d{1,2})\s*[)\]]|(?<![\w.])(\d{1,2})\s*[=:]")
+
+def find_heading(text, number, position):
+    """
+    Finds the heading of a numbered character, i.e. its number at the start of a line
+    followed by its name, as in '12. Shape of the skull'.
+
+    Args:
+        text: The context text.
+        number: The character number to look for.
+        position: The index in the text to search from.
+
+    Returns:
+        The index of the heading, or None if it isn't found.
+    """
+
+    heading = re.compile(rf"^[\s*#>|-]*{number}\b[.):\s*]*[^\W\d_]", re.MULTILINE)
+    match = heading.search(text, position)
+    return match.start() if match else None
+
+def character_spans(characters, text, context_tokens, offsets, index, shingle_size=SHINGLE_SIZE):
+    """
+    Locates each character's name in the context and the text that describes it.
+
+    A character's span runs from the end of its name to the next character's name, or
+    if that can't be found, to the heading of the character numbered after it, so that
+    its states are only looked up in its own description and not in its neighbours'.
+
+    Args:
+        characters: The character elements of the batch, in order.
+        text: The context text from `find_tokens`.
+        context_tokens: The word tokens of the context.
+        offsets: The start and end index of each token.
+        index: The shingle index from `build_shingle_index`.
+        shingle_size: The number of consecutive words in each shingle.
+
+    Returns:
+        A list with a tuple per character of its name's match score and the positions of
+        the first and last context tokens of its span.
+    """
+
+    names = [locate_match(character.attrib.get("name", ""), context_tokens, index, shingle_size) for character in characters]
+    token_starts = [start for start, _ in offsets]
+
+    spans = []
+    span_start = 0
+    for position, (character, (score, first, last)) in enumerate(zip(characters, names)):
+        if last is not None:
+            span_start = last + 1
+
+        ends = [first for _, first, _ in names[position + 1:] if first is not None and first >= span_start]
+        number = character.attrib.get("index", "")
+        if number.isdigit() and span_start < len(offsets):
+            heading = find_heading(text, int(number) + 1, offsets[span_start][0])
+            if heading is not None:
+                ends.append(bisect.bisect_left(token_starts, heading))
+        span_end = min(ends, default=len(context_tokens))
+
+        spans.append((score, span_start, span_end))
+        span_start = span_end
+    return spans
+
+def check_grounding(xml_character, context, shingle_size=SHINGLE_SIZE):
+    """
+    Checks that every character name and state label of a batch appears in its context,
+    that each state's code appears next to its label, and that no coded state in the
+    source was left out.
+
+    State labels are only looked up in their own character's span of the context, see
+    `character_spans`, so that a label copied from a neighbouring character doesn't count.
+
+    Args:
+        xml_character: The extracted XML of the batch as a string or bytes.
+        context: The context the batch was extracted from.
+        shingle_size: The number of consecutive words in each shingle.
+
+    Returns:
+        float: The confidence of the batch, i.e. the lowest match score of its names, states
+        and state codes, or 0 if the XML can't be parsed, holds no characters or omits a state.
+    """
+
+    try:
+        root = etree.fromstring(xml_character)
+    except (etree.XMLSyntaxError, ValueError):
+        return 0.0
+
+    characters = list(root.iter("character"))
+    if not characters:
+        return 0.0
+
+    text, context_tokens, offsets = find_tokens(str(context))
+    index = build_shingle_index(context_tokens, shingle_size)
+
+    scores = []
+    states = []
+    for character, (name_score, span_start, span_end) in zip(characters, character_spans(characters, text, context_tokens, offsets, index, shingle_size)):
+        scores.append(name_score)
+        span_tokens = context_tokens[span_start:span_end]
+        span_index = build_shingle_index(span_tokens, shingle_size)
+
+        values = set()
+        for state in character.findall("state"):
+            score, first, last = locate_match(state.text or "", span_tokens, span_index, shingle_size)
+            scores.append(score)
+            if first is not None:
+                first, last = first + span_start, last + span_start
+            states.append((state.attrib.get("value", ""), first, last))
+            values.add(state.attrib.get("value", "").strip())
+
+        # A state coded in the character's own description but missing from the extraction
+        if span_start < span_end:
+            text_end = offsets[span_end][0] if span_end < len(offsets) else len(text)
+            span_text = text[offsets[span_start][0]:text_end]
+            source_codes = {"".join(match.groups("")) for match in CODE_PATTERN.finditer(span_text)}
+            if source_codes - values:
+                scores.append(0.0)
+
+    scores.extend(check_state_codes(states, context_tokens) or [])
+
+    return min(scores)
+
+def ground_batches(xml_list, contexts):
+    """
+    Computes the grounding confidence of each batch against its context.
+
+    Args:
+        xml_list: A list of extracted XML strings, one per batch.
+        contexts: A list of contexts, one per batch.
+
+    Returns:
+        A list of confidences between 0 and 1.
+    """
+
+    return [check_grounding(xml_character, context) if xml_character else 0.0 for xml_character, context in zip(xml_list, contexts)]
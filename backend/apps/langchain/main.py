@@ -1,6 +1,4 @@
 import streamlit as st
-import time
-from concurrent.futures import ThreadPoolExecutor
 
 import litellm
 from langchain_google_vertexai import VertexAI
@@ -9,6 +7,9 @@ from google.oauth2 import service_account
 
 from langchain.evaluation import load_evaluator
 
+from backend.apps.retriever.main import estimate_tokens
+from backend.apps.scheduler.main import FairScheduler
+
 
 GEMINI_API_KEY = st.secrets.gemini.api_key
 
@@ -26,38 +27,40 @@ llm = VertexAI(model_name="gemini-1.5-pro")
 API_LIMIT_PER_MINUTE = 1000
 EVAL_API_LIMIT_PER_MINUTE = 300
 
-# Function to get responses from the language model
-def get_response(prompt_list, ai_model):
-    # Keep track of the number of requests made in the current minute
-    requests_this_minute = 0
-    start_time = time.time()
-
-    with ThreadPoolExecutor() as executor:
-        results = []
-        for prompt in prompt_list:
-            # Wait if the API limit is reached
-            while requests_this_minute >= API_LIMIT_PER_MINUTE:
-                time.sleep(60 - (time.time() - start_time))
-                requests_this_minute = 0
-                start_time = time.time()
-
-            # Submit the task to the executor
-            future = executor.submit(get_response_worker, prompt, ai_model)
-            results.append(future)
+# Maximum number of requests in flight at once, shared by every job in the process
+MAX_CONCURRENT_REQUESTS = 32
+MAX_CONCURRENT_EVAL_REQUESTS = 16
 
-            # Increment the request counter
-            requests_this_minute += 1
+# Shared pools so that concurrent jobs draw from one concurrency and rate budget
+response_scheduler = FairScheduler(MAX_CONCURRENT_REQUESTS, API_LIMIT_PER_MINUTE)
+eval_scheduler = FairScheduler(MAX_CONCURRENT_EVAL_REQUESTS, EVAL_API_LIMIT_PER_MINUTE)
 
-        # Retrieve the results from the futures
-        return [future.result() for future in results]
+# Function to queue requests to the language model
+def submit_responses(prompt_list, ai_model, job_id, budget=None):
+    """
+    Queues a language model request for each prompt over the shared response pool.
+
+    Args:
+        prompt_list: A list of prompts.
+        ai_model: The litellm model name.
+        job_id: The job the requests are scheduled under. Requests from different jobs
+            are interleaved fairly.
+        budget: An optional JobBudget. Requests are charged against it, and once it is
+            exhausted the job's queued requests are skipped.
+
+    Returns:
+        A list of futures resolving to the responses, in the order of the prompts.
+    """
+    return [response_scheduler.submit(job_id, get_response_worker, prompt, ai_model, budget, budget=budget) for prompt in prompt_list]
 
-def get_response_worker(item, ai_model):
+def get_response_worker(item, ai_model, budget=None):
     """
     Retrieves a response from the language model with automatic retries.
     """
     try:
         response = litellm.completion(
             model=ai_model,
+            timeout=budget.remaining_time() if budget else None,
             api_key=GEMINI_API_KEY,
             messages=[{"role": "user", "content": f"{item}"}],
             safety_settings=[
@@ -79,36 +82,34 @@ def get_response_worker(item, ai_model):
         }],
         )
         message_content = response.choices[0].message.content
+
+        if budget:
+            try:
+                cost = litellm.completion_cost(completion_response=response)
+            except Exception:
+                cost = 0.0  # Pricing is unknown for this model
+            budget.charge(response.usage.total_tokens, cost)
+
         return message_content
     except Exception as e:
         raise  # This ensures the retry mechanism is triggered
 
-# Function to get evaluations
-def get_eval(eval_prompt_list):
-    # Keep track of the number of requests made in the current minute
-    requests_this_minute = 0
-    start_time = time.time()
-
-    with ThreadPoolExecutor() as executor:
-        results = []
-        for eval_item in eval_prompt_list:
-            # Wait if the API limit is reached
-            while requests_this_minute >= EVAL_API_LIMIT_PER_MINUTE:
-                time.sleep(60 - (time.time() - start_time))
-                requests_this_minute = 0
-                start_time = time.time()
-
-            # Submit the task to the executor
-            future = executor.submit(get_eval_worker, eval_item)
-            results.append(future)
+# Function to queue evaluations
+def submit_evals(eval_prompt_list, job_id, budget=None):
+    """
+    Queues an evaluation of each prediction against its reference over the shared evaluation pool.
 
-            # Increment the request counter
-            requests_this_minute += 1
+    Args:
+        eval_prompt_list: A list of dictionaries from `build_evaluation_prompt`.
+        job_id: The job the requests are scheduled under.
+        budget: An optional JobBudget, see `submit_responses`.
 
-        # Retrieve the results from the futures
-        return [future.result() for future in results]
+    Returns:
+        A list of futures resolving to the evaluation scores, in the order of the prompts.
+    """
+    return [eval_scheduler.submit(job_id, get_eval_worker, eval_item, budget, budget=budget) for eval_item in eval_prompt_list]
 
-def get_eval_worker(eval_item):
+def get_eval_worker(eval_item, budget=None):
     
     try:
         evaluator = load_evaluator("labeled_criteria", llm=llm, criteria="correctness")
@@ -117,6 +118,26 @@ def get_eval_worker(eval_item):
             prediction=eval_item['prediction'],
             reference=eval_item['reference']
         )   
+
+        if budget:
+            # The evaluator doesn't report usage, so charge an estimate of the prompt size
+            budget.charge(sum(estimate_tokens(str(eval_item[key])) for key in ('input', 'prediction', 'reference')))
+
         return eval_result["score"]
     except Exception as e:
-        raise  # This ensures the retry mechanism is triggered
\ No newline at end of file
+        raise  # This ensures the retry mechanism is triggered
+
+def set_job_weight(job_id, weight):
+    """
+    Sets the share of the shared response and evaluation pools a job receives.
+    """
+    response_scheduler.set_weight(job_id, weight)
+    eval_scheduler.set_weight(job_id, weight)
+
+def cancel_job(job_id):
+    """
+    Drops a job's queued response and evaluation requests and its weight. Requests
+    already running are left to finish.
+    """
+    response_scheduler.cancel(job_id)
+    eval_scheduler.cancel(job_id)
@@ -1,6 +1,16 @@
-def insert_or_replace_charstatelabels(nexus_file, charstatelabels):
+import re
+from functools import lru_cache
+
+import numpy as np
+from lxml import etree
+
+# State symbols in the order of their state values
+STATE_SYMBOLS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+MISSING = -1
+POLYMORPHIC = -2
+
+def insert_or_replace_charstatelabels(nexus_content, charstatelabels):
 
-    nexus_content = nexus_file.read().decode('utf-8') 
     lines = nexus_content.splitlines()  # Split into lines
 
     # Deletion Logic
@@ -27,7 +37,7 @@ def insert_or_replace_charstatelabels(nexus_file, charstatelabels):
             matrix_indent = len(line) - len(line.lstrip())
             break
 
-    if matrix_index is not None:
+    if matrix_index is not None and charstatelabels:
 
         insert_index = matrix_index
         indented_lines = [f"{' ' * matrix_indent}{label}\n" for label in charstatelabels]
@@ -35,4 +45,182 @@ def insert_or_replace_charstatelabels(nexus_file, charstatelabels):
 
         
     new_nexus_content = "\n".join(lines)  # Combine lines using newlines
-    return new_nexus_content
\ No newline at end of file
+    return new_nexus_content
+
+def parse_nchar(nexus_content):
+    """
+    Reads the number of characters declared by the NCHAR setting of a NEXUS file.
+
+    Args:
+        nexus_content: The NEXUS file content as a string.
+
+    Returns:
+        The declared number of characters, or None if NCHAR is not set.
+    """
+
+    match = re.search(r"\bNCHAR\s*=\s*(\d+)", nexus_content, re.IGNORECASE)
+    return int(match.group(1)) if match else None
+
+@lru_cache(maxsize=8)
+def parse_matrix(nexus_content):
+    """
+    Parses the MATRIX block of a NEXUS file into a compact taxa x characters array.
+
+    Each cell holds the value of its state symbol, MISSING for '?' and '-', or
+    POLYMORPHIC for cells listing several states in () or {}. Rows split over
+    interleaved blocks are joined by taxon name. Results are cached, so batches
+    checked one at a time share a single parse; callers must not modify them.
+
+    Args:
+        nexus_content: The NEXUS file content as a string.
+
+    Returns:
+        A tuple of the list of taxa, the int8 array of state codes and a list of
+        (taxon, character, state) entries for polymorphic cells, or None if the file has no MATRIX.
+    """
+
+    content = re.sub(r"\[[^\]]*\]", "", nexus_content)  # Drop comments
+
+    # The MATRIX command of the CHARACTERS or DATA block, not e.g. a title mentioning a matrix
+    block = re.search(r"\bBEGIN\s+(?:CHARACTERS|DATA)\s*;(.*?)\bEND(?:BLOCK)?\s*;", content, re.IGNORECASE | re.DOTALL)
+    if not block:
+        return None
+    match = re.search(r"(?:^|;)[ \t]*MATRIX\b(.*?);", block.group(1), re.IGNORECASE | re.DOTALL | re.MULTILINE)
+    if not match:
+        return None
+
+    rows = {}
+    for line in match.group(1).splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        # Taxon names may be quoted and contain spaces
+        name_match = re.match(r"'((?:[^']|'')*)'|(\S+)", line)
+        taxon = name_match.group(1) if name_match.group(1) is not None else name_match.group(2)
+
+        cells = rows.setdefault(taxon, [])
+        data = line[name_match.end():]
+        i = 0
+        while i < len(data):
+            symbol = data[i]
+            if symbol in "({":
+                close = data.find(")" if symbol == "(" else "}", i)
+                close = len(data) if close == -1 else close
+                cells.append({STATE_SYMBOLS.index(s.upper()) for s in data[i + 1:close] if s.upper() in STATE_SYMBOLS})
+                i = close + 1
+                continue
+            if not symbol.isspace():
+                cells.append(STATE_SYMBOLS.index(symbol.upper()) if symbol.upper() in STATE_SYMBOLS else MISSING)
+            i += 1
+
+    taxa = list(rows)
+    nchar = max((len(cells) for cells in rows.values()), default=0)
+    codes = np.full((len(taxa), nchar), MISSING, dtype=np.int8)
+    polymorphisms = []
+
+    for row, taxon in enumerate(taxa):
+        for column, cell in enumerate(rows[taxon]):
+            if isinstance(cell, set):
+                codes[row, column] = POLYMORPHIC
+                polymorphisms.extend((row, column, state) for state in cell)
+            else:
+                codes[row, column] = cell
+
+    return taxa, codes, polymorphisms
+
+def get_observed_states(codes, polymorphisms):
+    """
+    Computes which states each character uses in the matrix.
+
+    Args:
+        codes: The array of state codes from `parse_matrix`.
+        polymorphisms: The polymorphic entries from `parse_matrix`.
+
+    Returns:
+        A boolean array of characters x state values, True where a taxon has the state.
+    """
+
+    observed = np.zeros((codes.shape[1], len(STATE_SYMBOLS)), dtype=bool)
+
+    taxa, characters = np.nonzero(codes >= 0)
+    observed[characters, codes[taxa, characters]] = True
+
+    if polymorphisms:
+        entries = np.array(polymorphisms)
+        observed[entries[:, 1], entries[:, 2]] = True
+
+    return observed
+
+def check_states_against_matrix(column_dict, xml_list, nexus_content):
+    """
+    Checks the extracted states of each batch against the states used in the MATRIX block.
+
+    A batch fails if it describes a character outside the matrix or leaves out a state
+    some taxon has. States above the highest state any taxon has are only reported,
+    as character lists often define states none of the sampled taxa show.
+
+    Args:
+        column_dict: A list of dictionaries with the 'start' and 'end' of each batch.
+        xml_list: A list of extracted XML strings, one per batch.
+        nexus_content: The NEXUS file content as a string.
+
+    Returns:
+        list: 1 for each batch consistent with the matrix (or when there is no matrix), 0 otherwise.
+    """
+
+    matrix = parse_matrix(nexus_content)
+    if matrix is None or matrix[1].shape[1] == 0:
+        return [1] * len(column_dict)
+
+    taxa, codes, polymorphisms = matrix
+    nchar = codes.shape[1]
+    observed = get_observed_states(codes, polymorphisms)
+
+    described = np.zeros_like(observed)
+    extracted = np.zeros(nchar, dtype=bool)
+    status = [1] * len(column_dict)
+
+    for i, (batch, xml_character) in enumerate(zip(column_dict, xml_list)):
+        if batch['end'] > nchar:
+            print(f"Error: Batch {batch['start']}-{batch['end']} exceeds the {nchar} characters in the matrix.")
+            status[i] = 0
+
+        try:
+            root = etree.fromstring(xml_character)
+        except (etree.XMLSyntaxError, ValueError):
+            continue  # Malformed batches are already rejected by `validate_xml`
+
+        for character in root.iter('character'):
+            try:
+                index = int(character.attrib.get('index', '')) - 1
+            except ValueError:
+                continue
+            if not 0 <= index < nchar:
+                continue
+
+            extracted[index] = True
+            for state in character.findall('state'):
+                value = state.attrib.get('value', '').strip().upper()
+                if len(value) == 1 and value in STATE_SYMBOLS:
+                    described[index, STATE_SYMBOLS.index(value)] = True
+
+    # Compare all extracted characters against the matrix at once
+    has_observations = observed.any(axis=1)
+    highest_observed = observed.shape[1] - 1 - np.argmax(observed[:, ::-1], axis=1)
+    missing = observed & ~described
+    extra = described & (np.arange(observed.shape[1]) > highest_observed[:, None]) & has_observations[:, None]
+    inconsistent = missing.any(axis=1) & extracted
+    unobserved = extra.any(axis=1) & extracted
+
+    for i, batch in enumerate(column_dict):
+        batch_range = slice(batch['start'] - 1, min(batch['end'], nchar))
+        flagged = np.flatnonzero(inconsistent[batch_range]) + batch['start']
+        if flagged.size:
+            print(f"Error: Characters {flagged.tolist()} leave out states used in the matrix.")
+            status[i] = 0
+        noted = np.flatnonzero(unobserved[batch_range]) + batch['start']
+        if noted.size:
+            print(f"Warning: Characters {noted.tolist()} describe states no taxon in the matrix has.")
+
+    return status
@@ -0,0 +1,332 @@
+import argparse
+import os
+import socket
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+from backend.apps.database.main import identify_invalid_batches, initialize_database, update_database, read_database, get_labels, cache_extracted_spans, claim_batches, release_batches, renew_leases, count_leased_batches, count_batches, read_nexus, sync_job_budget, LEASE_SECONDS
+from backend.apps.nex.main import insert_or_replace_charstatelabels, check_states_against_matrix, parse_nchar
+from backend.apps.doc.main import convert_document
+from backend.apps.grounding.main import ground_batches, GROUNDING_THRESHOLD
+from backend.apps.prompt.main import build_rag_prompt, build_evaluation_prompt
+from backend.apps.retriever.main import MAX_CONTEXT_TOKENS
+from backend.apps.scheduler.main import BUDGET_POLL_INTERVAL, JobBudget
+from backend.apps.langchain.main import submit_responses, submit_evals, set_job_weight, cancel_job
+from backend.apps.utils.main import get_sanitized_filename
+from backend.apps.xml.main import parse_xml, validate_xml, build_character_state_labels
+
+MAX_ATTEMPTS = 5
+
+# How often a worker waiting on batches leased by other workers checks the store again, in seconds
+LEASE_POLL_INTERVAL = 5.0
+
+# How often a worker adds its spending to the job's totals in the store and picks up
+# other workers' spending and cancellations, in seconds
+BUDGET_SYNC_INTERVAL = 5.0
+
+# Batches a worker claims at a time, and the most it holds at once. Small claims let
+# other workers share a job; holding several claims keeps the request pool busy.
+CLAIM_SIZE = 4
+MAX_CLAIMED_BATCHES = 32
+
+def run_pipeline(process_name, raw_characters, num_characters, nexus_file, ai_model, max_attempts=MAX_ATTEMPTS, weight=1, budget=None, on_progress=None, on_batch=None, max_context_tokens=MAX_CONTEXT_TOKENS):
+    """
+    Extracts the character state labels for one document and adds them to its NEXUS file.
+
+    Args:
+        process_name: The sanitized name of the job, used as its table name and scheduling key.
+        raw_characters: The extracted text of the character list.
+        num_characters: The number of characters to extract, or 0 to use the NCHAR of the NEXUS file.
+        nexus_file: The uploaded NEXUS file object.
+        ai_model: The litellm model name.
+        max_attempts: The number of times a batch is attempted before it is given up.
+        weight: The job's share of the shared request pools relative to other jobs.
+        budget: An optional JobBudget. Once its deadline or spending cap is reached, or it
+            is cancelled, pending requests are dropped and the batches finished so far are
+            written to a partial NEXUS file.
+        on_progress: An optional callable receiving progress messages.
+        on_batch: An optional callable receiving a dictionary with the batch's 'start' and
+            'end', whether it is 'complete', and the job's 'completed_batches' and
+            'total_batches', each time a batch is validated and evaluated.
+        max_context_tokens: The maximum size of each batch's context in estimated tokens.
+
+    Returns:
+        A tuple of the updated NEXUS file content and the list of batches that could not be extracted.
+    """
+    report = on_progress or (lambda message: None)
+
+    if weight != 1:
+        set_job_weight(process_name, weight)
+
+    nexus_content = nexus_file.read().decode('utf-8')
+    declared_characters = parse_nchar(nexus_content)
+    if not num_characters:
+        num_characters = declared_characters or 0
+    elif declared_characters and num_characters != declared_characters:
+        report(f"Extracting {num_characters} characters, but the NEXUS file declares NCHAR={declared_characters}.")
+
+    token_report = initialize_database(process_name, raw_characters, num_characters, nexus_content, max_context_tokens, budget)
+    saved_tokens = token_report["fixed_window_tokens"] - token_report["context_tokens"]
+    report(f"Context windows use ~{token_report['context_tokens']} tokens ({saved_tokens} fewer than fixed padding).")
+    if token_report["fallback_batches"]:
+        report(f"Located {token_report['fallback_batches']} batches without character numbers by keyword search.")
+    if token_report["reused_characters"]:
+        report(f"Reusing {token_report['reused_characters']} unchanged characters from earlier extractions.")
+
+    try:
+        run_worker(process_name, ai_model, max_attempts, budget=budget, on_progress=report, on_batch=on_batch)
+    finally:
+        # Drop the job's leftover requests and its scheduling weight
+        cancel_job(process_name)
+
+    remaining_batches = identify_invalid_batches(process_name)
+    cache_extracted_spans(process_name)
+    if not (budget and budget.exhausted()):
+        if remaining_batches:
+            report("Incomplete Characters Extracted...")
+        else:
+            report("Character Extraction Complete!")
+
+    report("Adding Characters to Nexus File...")
+    _, updated_nexus_file = build_nexus(process_name, nexus_content)
+
+    return updated_nexus_file, remaining_batches
+
+def run_worker(process_name, ai_model, max_attempts=MAX_ATTEMPTS, claim_size=CLAIM_SIZE, max_claimed=MAX_CLAIMED_BATCHES, budget=None, on_progress=None, on_batch=None):
+    """
+    Extracts the batches of an initialized job until none are left to claim.
+
+    Batches are leased from the store a few at a time and more are claimed as they
+    finish, so several workers, in this or other processes and hosts sharing the store,
+    can drain the same job without duplicating work. Leases are renewed while their
+    batches are being extracted, and batches leased by other workers are waited for.
+
+    Spending is shared through the store, so the job's limits apply to all of its
+    workers together, and cancelling the job on any worker stops them all.
+
+    Progress callbacks are made from the calling thread.
+
+    Args:
+        process_name: The sanitized name of the job.
+        ai_model: The litellm model name.
+        max_attempts: The number of times a batch is claimed before it is given up.
+        claim_size: The number of batches to claim at a time.
+        max_claimed: The most batches the worker holds, and so has in flight, at once.
+        budget: An optional JobBudget, see `run_pipeline`. Workers without one take the
+            limits the job was created with.
+        on_progress: An optional callable receiving progress messages.
+        on_batch: An optional callable receiving batch events, see `run_pipeline`.
+    """
+    report = on_progress or (lambda message: None)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    nexus_content = read_nexus(process_name) or ""
+    budget = budget or JobBudget()
+
+    # The spending already in the job's totals, and the totals as last read
+    synced_tokens, synced_cost = 0, 0.0
+    job_tokens, job_cost = 0, 0.0
+    synced_at = 0.0
+
+    def sync_budget():
+        nonlocal synced_tokens, synced_cost, job_tokens, job_cost, synced_at
+        tokens, cost = budget.tokens_used - synced_tokens, budget.cost - synced_cost
+        job_budget = sync_job_budget(process_name, tokens, cost, budget.exhausted() == "cancelled")
+        synced_at = time.time()
+
+        if budget.deadline is None:
+            budget.deadline = job_budget["deadline"]
+        if budget.max_tokens is None:
+            budget.max_tokens = job_budget["max_tokens"]
+        if budget.max_cost is None:
+            budget.max_cost = job_budget["max_cost"]
+        if job_budget["cancelled"]:
+            budget.cancel()
+
+        # Charge what the other workers spent since the last sync
+        other_tokens = job_budget["tokens_used"] - job_tokens - tokens
+        other_cost = job_budget["cost"] - job_cost - cost
+        budget.charge(other_tokens, other_cost)
+        synced_tokens, synced_cost = synced_tokens + tokens + other_tokens, synced_cost + cost + other_cost
+        job_tokens, job_cost = job_budget["tokens_used"], job_budget["cost"]
+
+    def save_batch(batch, xml_character, validation, evaluation=None):
+        update_database(process_name, [batch], [xml_character], column_name="xml_characters")
+        update_database(process_name, [batch], [validation], column_name="validation_status")
+        if evaluation is None:
+            return
+
+        update_database(process_name, [batch], [evaluation], column_name="evaluation_status")
+        if on_batch:
+            # Counted from the store, as other workers may be completing batches too
+            completed_batches, total_batches = count_batches(process_name)
+            on_batch({"start": batch["start"], "end": batch["end"], "complete": bool(validation and evaluation), "completed_batches": completed_batches, "total_batches": total_batches})
+
+    # Each pending future maps to its kind of request, batch, context, prompt and extracted XML
+    pending = {}
+    claimed = 0
+    first_claim = True
+    retrying = False
+    renewed_at = time.time()
+
+    try:
+        while True:
+
+            if budget.exhausted() or time.time() - synced_at > BUDGET_SYNC_INTERVAL:
+                sync_budget()
+            stop_reason = budget.exhausted()
+            if stop_reason:
+                report(f"Stopping early ({stop_reason}), keeping the characters extracted so far.")
+                cancel_job(process_name)
+                break
+
+            # Top the worker up to max_claimed batches
+            while claimed < max_claimed:
+                batches = claim_batches(process_name, worker_id, max_attempts, min(claim_size, max_claimed - claimed))
+                if not batches:
+                    break
+                claimed += len(batches)
+
+                if first_claim:
+                    report("Preparing Data Batches...")
+                elif not retrying and any(batch["attempt"] > 1 for batch in batches):
+                    retrying = True
+                    report("Reattempting Failed Batches")
+
+                try:
+                    context = read_database(process_name, batches, column_name="context")
+                    prompt = read_database(process_name, batches, column_name="prompt")
+                    rag_prompt = build_rag_prompt(context, prompt)
+                    response_futures = submit_responses(rag_prompt, ai_model, process_name, budget)
+                except Exception as e:
+                    report("Reattempting as it raised an internal error.")
+                    release_batches(process_name, worker_id, batches)
+                    claimed -= len(batches)
+                    continue
+
+                for i, future in enumerate(response_futures):
+                    pending[future] = ("response", batches[i], context[i], prompt[i], None)
+
+                if first_claim:
+                    report("Querying Language Model...")
+                    report("Validating and Evaluating Response...")
+                    first_claim = False
+
+            if not pending:
+                if not count_leased_batches(process_name):
+                    break
+                # Other workers hold the remaining batches, retry any they leave incomplete
+                time.sleep(LEASE_POLL_INTERVAL)
+                continue
+
+            # Keep the leases of batches still in flight from expiring
+            if time.time() - renewed_at > LEASE_SECONDS / 3:
+                renew_leases(process_name, worker_id)
+                renewed_at = time.time()
+
+            done, _ = wait(pending, timeout=BUDGET_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, batch, context, prompt, xml_character = pending.pop(future)
+                failed = future.cancelled() or future.exception() is not None
+                try:
+                    if kind == "response":
+                        xml_character = parse_xml(["" if failed else future.result()])[0]
+
+                        # Batches whose states disagree with the MATRIX are regenerated without an evaluation call
+                        valid = validate_xml([batch], [xml_character])[0] and check_states_against_matrix([batch], [xml_character], nexus_content)[0]
+
+                        # Accept well-grounded batches locally and only escalate the uncertain ones to the LLM
+                        if valid and ground_batches([xml_character], [context])[0] < GROUNDING_THRESHOLD:
+                            save_batch(batch, xml_character, valid)
+                            eval_future = submit_evals(build_evaluation_prompt([prompt], [xml_character], [context]), process_name, budget)[0]
+                            pending[eval_future] = ("evaluation", batch, context, prompt, xml_character)
+                            continue
+                        save_batch(batch, xml_character, valid, evaluation=valid)
+                    else:
+                        # Failed evaluations count as failed batches
+                        score = 0 if failed else future.result()
+                        save_batch(batch, xml_character, 1, evaluation=score or 0)
+                except Exception as e:
+                    # The claim has counted as an attempt, so a batch that keeps failing is eventually given up
+                    report("Reattempting as it raised an internal error.")
+
+                release_batches(process_name, worker_id, [batch])
+                claimed -= 1
+
+    finally:
+        release_batches(process_name, worker_id)
+        sync_budget()
+
+def build_nexus(process_name, nexus_content):
+    """
+    Builds the NEXUS file from the characters a job has extracted so far.
+
+    Args:
+        process_name: The sanitized name of the job.
+        nexus_content: The content of the uploaded NEXUS file.
+
+    Returns:
+        A tuple of the CHARSTATELABELS lines and the updated NEXUS file content.
+    """
+    characterstatelabels_xml = get_labels(process_name)
+
+    characterstatelabels = build_character_state_labels(characterstatelabels_xml)
+
+    return characterstatelabels, insert_or_replace_charstatelabels(nexus_content, characterstatelabels)
+
+def run_multi_document_job(documents, ai_model, max_attempts=MAX_ATTEMPTS, on_progress=None):
+    """
+    Processes several (character list, NEXUS) pairs side by side over the shared request pools.
+
+    Each document's batches are scheduled fairly against the others, weighted by the
+    document's optional 'weight', so one large paper can't starve the small ones.
+
+    Args:
+        documents: A list of dictionaries with 'character_list', 'target_pages',
+            'num_characters' and 'nexus_file' keys, and an optional 'target_unit' ('page'
+            or 'section'), 'weight' and JobBudget 'budget'.
+        ai_model: The litellm model name.
+        max_attempts: The number of times a batch is attempted before it is given up.
+        on_progress: An optional callable receiving the process name and a progress message.
+
+    Yields:
+        A tuple of the process name, the updated NEXUS file content, the remaining
+        batches and the exception the document raised (or None) for each document,
+        as soon as that document is done. A failed document has no NEXUS content
+        or remaining batches and doesn't stop the others.
+    """
+
+    def process(document):
+        filename, file_extension = os.path.splitext(document["character_list"].name)
+        # Documents sharing a file name must not share a table
+        process_name = f"{get_sanitized_filename(filename)}_{uuid.uuid4().hex[:8]}"
+        report = (lambda message: on_progress(process_name, message)) if on_progress else None
+
+        try:
+            raw_characters = convert_document(document["character_list"], document["target_pages"], document.get("target_unit", "page"))
+            updated_nexus_file, remaining_batches = run_pipeline(
+                process_name, raw_characters, document["num_characters"], document["nexus_file"], ai_model,
+                max_attempts=max_attempts, weight=document.get("weight", 1), budget=document.get("budget"), on_progress=report,
+            )
+        except Exception as e:
+            return process_name, None, None, e
+        return process_name, updated_nexus_file, remaining_batches, None
+
+    # The coordinating threads only wait on the shared pools, so one per document is enough
+    with ThreadPoolExecutor(max_workers=max(1, len(documents))) as executor:
+        futures = [executor.submit(process, document) for document in documents]
+        for future in as_completed(futures):
+            yield future.result()
+
+def main():
+    parser = argparse.ArgumentParser(description="Help drain the batches of a job started elsewhere, e.g. on another host sharing the store.")
+    parser.add_argument("process_name", help="The job's table name.")
+    parser.add_argument("--model", default="gemini/gemini-1.5-flash", help="The litellm model name.")
+    parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS)
+    parser.add_argument("--claim-size", type=int, default=CLAIM_SIZE, help="The number of batches to claim at a time.")
+    args = parser.parse_args()
+
+    run_worker(args.process_name, args.model, args.max_attempts, claim_size=args.claim_size, on_progress=print)
+
+if __name__ == "__main__":
+    main()
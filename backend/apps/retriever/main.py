@@ -1,3 +1,5 @@
+import hashlib
+import math
 import re
 
 def extract_numbers_with_index(text):
@@ -42,41 +44,302 @@ def order_numbers_by_occurrence(numbers_with_index, end_number):
 
     return ordered_numbers
 
-def extract_text_between_numbers(text, start_number, end_number, numbers_with_index, start_context_length=1000, end_context_length=1000):
+CHARS_PER_TOKEN = 4
+MAX_CONTEXT_TOKENS = 4000
+
+def estimate_tokens(text):
     """
-    Extracts the text between the first occurrences of two given numbers in a text string,
-    including context before the start number and after the end number.
+    Estimates the number of language model tokens in a text string.
 
     Args:
-        text: The text string to search.
+        text: The text string to measure, or its length.
+
+    Returns:
+        The approximate token count, assuming CHARS_PER_TOKEN characters per token.
+    """
+
+    length = text if isinstance(text, int) else len(text)
+    return -(-length // CHARS_PER_TOKEN)
+
+def get_context_bounds(text_length, start_number, end_number, numbers_with_index, start_context_length=1000, end_context_length=1000, max_context_tokens=MAX_CONTEXT_TOKENS, adaptive=True):
+    """
+    Finds the window of a text covering the characters between two given numbers.
+
+    With adaptive windows the window starts at the character just before the start
+    number and ends where the character just after the end number finishes, so each
+    batch carries exactly one neighbouring character on either side. The fixed
+    context lengths are only used where a neighbouring character can't be located.
+
+    Args:
+        text_length: The length of the text string to search.
         start_number: The starting number.
         end_number: The ending number.
-        numbers_with_index: A list of tuples containing numbers and their indices from `extract_numbers_with_index`.
-        context_length: The number of characters to include before and after the target numbers (default 500).
+        numbers_with_index: A list of tuples containing numbers and their indices from `order_numbers_by_occurrence`.
+        start_context_length: The number of characters to include before the start number when its predecessor isn't found (default 1000).
+        end_context_length: The number of characters to include after the last located character when its successor isn't found (default 1000).
+        max_context_tokens: The maximum size of the window in estimated tokens (default MAX_CONTEXT_TOKENS).
+        adaptive: Whether to snap the window to neighbouring characters instead of padding with fixed context lengths.
 
     Returns:
-        The text between the two numbers, including context, or an empty string if either number is not found.
+        A tuple of the start and end index of the window, or None if either number is not found.
     """
 
-    start_index = None
-    end_index = None
-
+    positions = {}
     for number, index in numbers_with_index:
-        if number == start_number and start_index is None:
-            start_index = max(0, index - start_context_length)
-        elif number == end_number and end_index is None:
-            end_index = min(len(text), index + end_context_length)
+        positions.setdefault(number, index)
 
-    if start_index is not None and end_index is not None:
-        return text[start_index:end_index]
-    else:
-        return ""
+    if start_number not in positions or end_number not in positions:
+        return None
+
+    if not adaptive:
+        start_index = max(0, positions[start_number] - start_context_length)
+        end_index = min(text_length, positions[end_number] + end_context_length)
+        return start_index, end_index
+
+    # Snap to the start of the preceding character and the end of the following one
+    start_index = positions.get(start_number - 1)
+    if start_index is None:
+        start_index = max(0, positions[start_number] - start_context_length)
+
+    end_index = positions.get(end_number + 2)
+    if end_index is None:
+        last_located = positions.get(end_number + 1, positions[end_number])
+        end_index = min(text_length, last_located + end_context_length)
+
+    # Trim the leading neighbour first, then the trailing text, to respect the token cap
+    max_length = max_context_tokens * CHARS_PER_TOKEN
+    if end_index - start_index > max_length:
+        start_index = max(start_index, min(positions[start_number], end_index - max_length))
+        end_index = min(end_index, start_index + max_length)
+
+    return start_index, end_index
+
+def retrieve_context_bounds(text, start_number, end_number, max_context_tokens=MAX_CONTEXT_TOKENS, token_report=None):
+    """
+    Locates the context for a batch of characters in the document text.
+
+    Args:
+        text: The document text.
+        start_number: The first character number of the batch.
+        end_number: The last character number of the batch.
+        max_context_tokens: The maximum size of the context in estimated tokens.
+        token_report: An optional dictionary accumulating 'context_tokens' and
+            'fixed_window_tokens' so callers can report the savings over fixed padding.
+
+    Returns:
+        A tuple of the start and end index of the context, or None if the batch can't be located.
+    """
+
+    numbers_with_index = extract_numbers_with_index(text)
+    # Order one character past the batch so the trailing neighbour can be bounded
+    ordered_numbers = order_numbers_by_occurrence(numbers_with_index, end_number + 2)
+
+    bounds = get_context_bounds(len(text), start_number, end_number, ordered_numbers, max_context_tokens=max_context_tokens)
+
+    if token_report is not None and bounds is not None:
+        fixed_start, fixed_end = get_context_bounds(len(text), start_number, end_number, ordered_numbers, adaptive=False)
+        token_report["context_tokens"] = token_report.get("context_tokens", 0) + estimate_tokens(bounds[1] - bounds[0])
+        token_report["fixed_window_tokens"] = token_report.get("fixed_window_tokens", 0) + estimate_tokens(fixed_end - fixed_start)
+
+    return bounds
+
+def locate_character_spans(text, total_characters, end_context_length=1000):
+    """
+    Locates the source text of each character in the document.
+
+    A character's span runs from its number to the next located character, or for
+    the last located character, up to end_context_length characters past its number.
+
+    Args:
+        text: The document text.
+        total_characters: The number of characters in the document.
+        end_context_length: The length of the last character's span.
+
+    Returns:
+        A dictionary mapping each located character number to the start and end index of its span.
+    """
 
-def retrieve_context(text, start_number, end_number):
     numbers_with_index = extract_numbers_with_index(text)
-    ordered_numbers = order_numbers_by_occurrence(numbers_with_index, end_number)
+    ordered_numbers = order_numbers_by_occurrence(numbers_with_index, total_characters)
+
+    spans = {}
+    for i, (number, index) in enumerate(ordered_numbers):
+        end_index = ordered_numbers[i + 1][1] if i + 1 < len(ordered_numbers) else min(len(text), index + end_context_length)
+        spans[number] = (index, end_index)
+    return spans
+
+def fingerprint_span(text, number):
+    """
+    Fingerprints a character's source span, ignoring differences in whitespace.
+
+    Args:
+        text: The text of the span.
+        number: The character number, so that renumbered characters don't match.
+
+    Returns:
+        The hex digest identifying the span.
+    """
+
+    normalized = " ".join(text.split())
+    return hashlib.sha256(f"{number}\0{normalized}".encode("utf-8")).hexdigest()
+
+# Words typical of character state descriptions, used to tell character blocks from prose,
+# captions and references
+STATE_KEYWORDS = ["absent", "present", "state", "states", "or", "yes", "no", "0", "1", "2"]
+
+# A block must score at least this share of the region's median state score to count as a character
+CHARACTER_BLOCK_RATIO = 0.5
+
+# A character number at the start of a line followed by a name, as in '12. Shape of the skull'
+HEADING_PATTERN = re.compile(r"\d+\s*[.):]?[\s*]*([^\W\d_][^\n]*)")
+
+def find_heading_name(text, span):
+    """
+    Checks that a located character starts with a character heading and reads its name.
+
+    Numbers that merely appear in the text, such as state codes like '(0)', years or
+    numbers inside a line, are not headings, and neither are numbered lines with no
+    state keywords up to the next located character, such as references.
+
+    Args:
+        text: The document text.
+        span: The start and end index of the character's span from `locate_character_spans`.
+
+    Returns:
+        The rest of the heading line after the number, or None if the number isn't a heading.
+    """
+
+    index, end_index = span
+    line_start = text.rfind("\n", 0, index) + 1
+    if text[line_start:index].strip(" \t*#>|-"):
+        return None
+
+    match = HEADING_PATTERN.match(text, index)
+    if not match or not set(re.findall(r"\w+", text[index:end_index].lower())) & set(STATE_KEYWORDS):
+        return None
+    return match.group(1)
+
+class BlockIndex:
+    """
+    A BM25 inverted index over the blocks (lines) of a document.
+
+    The document converters emit one page block per line, so each line is indexed
+    as a passage together with its position in the text.
+    """
+
+    def __init__(self, text, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.blocks = []
+        self.postings = {}
+
+        position = 0
+        for line in text.splitlines(keepends=True):
+            terms = re.findall(r"\w+", line.lower())
+            if terms:
+                block = len(self.blocks)
+                self.blocks.append((position, position + len(line), len(terms)))
+                for term in terms:
+                    frequencies = self.postings.setdefault(term, {})
+                    frequencies[block] = frequencies.get(block, 0) + 1
+            position += len(line)
+
+        self.average_length = sum(length for _, _, length in self.blocks) / max(1, len(self.blocks))
+
+    def score(self, query_terms):
+        """
+        Scores every block against the query terms.
+
+        Args:
+            query_terms: A list of lowercase query terms.
+
+        Returns:
+            A list with the BM25 score of each block.
+        """
+
+        scores = [0.0] * len(self.blocks)
+        for term in set(query_terms):
+            frequencies = self.postings.get(term)
+            if not frequencies:
+                continue
+            idf = math.log(1 + (len(self.blocks) - len(frequencies) + 0.5) / (len(frequencies) + 0.5))
+            for block, frequency in frequencies.items():
+                length = self.blocks[block][2]
+                scores[block] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * length / self.average_length))
+        return scores
+
+def retrieve_fallback_bounds(text, index, start_number, end_number, total_characters, character_spans, max_context_tokens=MAX_CONTEXT_TOKENS):
+    """
+    Locates the context for a batch the numbering heuristic can't find, using the block index.
+
+    Only located characters whose number starts a heading are trusted as neighbours,
+    so state codes and reference numbers taken for character numbers are ignored. The
+    search is narrowed to the blocks between the nearest trusted neighbours before and
+    after the batch, and those blocks are ranked against the state keywords and the
+    neighbours' names. Blocks ranking well below the region's median are prose,
+    captions or references; the rest are taken to be the unnumbered characters, in
+    order. The batch is mapped onto its share of them, with one block of context on
+    either side, and the grounding check and evaluation catch a misplaced window.
+
+    Args:
+        text: The document text.
+        index: The BlockIndex of the document.
+        start_number: The first character number of the batch.
+        end_number: The last character number of the batch.
+        total_characters: The number of characters in the document.
+        character_spans: The located character spans from `locate_character_spans`.
+        max_context_tokens: The maximum size of the context in estimated tokens.
+
+    Returns:
+        A tuple of the start and end index of the context, or None if the document has no text blocks.
+    """
+
+    if not index.blocks:
+        return None
+
+    headings = {number: find_heading_name(text, span) for number, span in character_spans.items()}
+    trusted = [number for number, name in headings.items() if name is not None]
+
+    # Narrow the search to the blocks strictly between the nearest trusted neighbours
+    previous_number = max((number for number in trusted if number < start_number), default=0)
+    next_number = min((number for number in trusted if number > end_number), default=total_characters + 1)
+    after = character_spans[previous_number][0] if previous_number else -1
+    before = character_spans[next_number][0] if next_number in character_spans else len(text)
+
+    region_blocks = [block for block, (block_start, block_end, _) in enumerate(index.blocks) if block_start > after and block_end <= before]
+
+    # Rank the region's blocks as character descriptions, and include the neighbours' own lines
+    query = list(STATE_KEYWORDS)
+    for number in (previous_number, next_number):
+        if number in trusted:
+            query.extend(re.findall(r"\w+", headings[number].lower()))
+    scores = index.score(query)
+
+    positive = sorted(scores[block] for block in region_blocks if scores[block] > 0)
+    threshold = CHARACTER_BLOCK_RATIO * positive[len(positive) // 2] if positive else 0.0
+    candidates = [block for block in region_blocks if scores[block] > 0 and scores[block] >= threshold] or region_blocks
+
+    if not candidates:
+        start_index, end_index = max(0, after), before
+    else:
+        # Map the batch onto its expected share of the character blocks
+        gap = next_number - previous_number - 1
+        first = int((start_number - previous_number - 1) / gap * len(candidates))
+        last = math.ceil((end_number - previous_number) / gap * len(candidates))
+        # At the ends of the region, take in the neighbour's heading line, or stop at the
+        # first and last character blocks rather than surrounding prose or references
+        if first > 0:
+            start_index = index.blocks[candidates[first - 1]][0]
+        else:
+            start_index = max(0, after) if previous_number else index.blocks[candidates[0]][0]
+        if last < len(candidates):
+            end_index = index.blocks[candidates[last]][1]
+        elif next_number in character_spans:
+            end_index = next((block_end for block_start, block_end, _ in index.blocks if block_end > before), before)
+        else:
+            end_index = index.blocks[candidates[-1]][1]
+        if start_index >= end_index:
+            start_index, end_index = max(0, after), before
 
-    extracted_text = extract_text_between_numbers(text, start_number, end_number, ordered_numbers)
-    
-    return extracted_text
-    
\ No newline at end of file
+    max_length = max_context_tokens * CHARS_PER_TOKEN
+    return start_index, min(end_index, start_index + max_length)
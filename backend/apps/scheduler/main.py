@@ -0,0 +1,211 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# How often waiting callers re-check their job's budget, in seconds
+BUDGET_POLL_INTERVAL = 1.0
+
+
+class RateLimiter:
+    """
+    Limits the number of requests started within any sliding one-minute window.
+    """
+
+    def __init__(self, requests_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self._timestamps = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request can be started without exceeding the limit.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                while self._timestamps and now - self._timestamps[0] >= 60:
+                    self._timestamps.popleft()
+
+                if len(self._timestamps) < self.requests_per_minute:
+                    self._timestamps.append(now)
+                    return
+
+                wait_time = 60 - (now - self._timestamps[0])
+
+            time.sleep(wait_time)
+
+
+class JobBudget:
+    """
+    Tracks the time, token and cost limits of one job and whether it has been cancelled.
+
+    Any limit left as None is not enforced.
+    """
+
+    def __init__(self, deadline_seconds=None, max_tokens=None, max_cost=None):
+        self.deadline = time.time() + deadline_seconds if deadline_seconds else None
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.tokens_used = 0
+        self.cost = 0.0
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    def charge(self, tokens, cost=0.0):
+        """
+        Records the tokens and cost spent by a finished request.
+        """
+        with self._lock:
+            self.tokens_used += tokens
+            self.cost += cost
+
+    def cancel(self):
+        """
+        Marks the job as abandoned so no further work is started for it.
+        """
+        self._cancelled.set()
+
+    def remaining_time(self):
+        """
+        Returns the seconds left until the deadline, or None if there is no deadline.
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def exhausted(self):
+        """
+        Returns the reason the job must stop, or None while it is within its limits.
+        """
+        if self._cancelled.is_set():
+            return "cancelled"
+        if self.deadline is not None and time.time() >= self.deadline:
+            return "deadline reached"
+        if self.max_tokens is not None and self.tokens_used >= self.max_tokens:
+            return "token budget spent"
+        if self.max_cost is not None and self.cost >= self.max_cost:
+            return "cost budget spent"
+        return None
+
+
+class FairScheduler:
+    """
+    Runs tasks from several jobs over one shared worker pool and rate limit.
+
+    Each job has its own queue. Queued tasks are dispatched in weighted round-robin
+    order, so a job with weight 2 gets two tasks started for every one of a job with
+    weight 1, and a large job can't starve the others.
+    """
+
+    def __init__(self, max_workers, requests_per_minute):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._limiter = RateLimiter(requests_per_minute)
+
+        self._condition = threading.Condition()
+        self._queues = {}
+        self._weights = {}
+        self._credits = {}
+        self._rotation = deque()
+
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def set_weight(self, job_id, weight):
+        """
+        Sets the share of the pool a job receives relative to other jobs (default 1).
+        """
+        with self._condition:
+            self._weights[job_id] = max(1, int(weight))
+
+    def submit(self, job_id, fn, *args, budget=None):
+        """
+        Queues a task for a job and returns a Future for its result.
+
+        If the task's budget is exhausted by the time it is dispatched, it is
+        cancelled instead of run, even if nobody is waiting on the job any more.
+        """
+        future = Future()
+        with self._condition:
+            if job_id not in self._queues:
+                self._queues[job_id] = deque()
+                self._credits[job_id] = self._weights.get(job_id, 1)
+                self._rotation.append(job_id)
+            self._queues[job_id].append((future, fn, args, budget))
+            self._condition.notify()
+        return future
+
+    def cancel(self, job_id):
+        """
+        Cancels every queued task of a job and forgets its weight. Tasks already
+        running are left to finish.
+        """
+        with self._condition:
+            self._weights.pop(job_id, None)
+            queue = self._queues.pop(job_id, None)
+            self._credits.pop(job_id, None)
+            if queue is None:
+                return
+            self._rotation.remove(job_id)
+
+        for future, fn, args, budget in queue:
+            future.cancel()
+
+    def _next_task(self):
+        # Called with the condition held and at least one job queued
+        job_id = self._rotation[0]
+        queue = self._queues[job_id]
+        task = queue.popleft()
+        self._credits[job_id] -= 1
+
+        if not queue:
+            # The job has drained, drop it from the rotation
+            self._rotation.popleft()
+            del self._queues[job_id]
+            del self._credits[job_id]
+        elif self._credits[job_id] <= 0:
+            # The job has used its share for this round, move it to the back
+            self._credits[job_id] = self._weights.get(job_id, 1)
+            self._rotation.rotate(-1)
+
+        return task
+
+    def _dispatch(self):
+        while True:
+            self._slots.acquire()
+
+            with self._condition:
+                while not self._rotation:
+                    self._condition.wait()
+                future, fn, args, budget = self._next_task()
+
+            if future.cancelled() or (budget is not None and budget.exhausted()):
+                future.cancel()
+                self._slots.release()
+                continue
+
+            self._limiter.acquire()
+
+            # The budget may have run out while waiting on the rate limit
+            if (budget is not None and budget.exhausted()) or not future.set_running_or_notify_cancel():
+                future.cancel()
+                self._slots.release()
+                continue
+
+            try:
+                self._executor.submit(self._run, future, fn, args)
+            except RuntimeError as e:
+                # The interpreter is shutting down and the pool no longer accepts work
+                future.set_exception(e)
+                return
+
+    def _run(self, future, fn, args):
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            self._slots.release()
@@ -74,6 +74,12 @@ def check_count_and_range(xml_tree, start_index, end_index):
             print(f"Error: Character at index {character.attrib['index']} is missing 'name' attribute.")
             return False
 
+    # 1b. Check that every state has a label
+    for state in root.iter('state'):
+        if not (state.text or '').strip():
+            print(f"Error: State {state.attrib.get('value')} of character {state.getparent().attrib.get('index')} has no label.")
+            return False
+
     # 2. Check index range and presence of each index
     expected_indices = set(range(start_index, end_index + 1))
     found_indices = set()
@@ -141,11 +147,13 @@ def build_character_state_labels(xml_tree):
         else:
             character_number = len(character_state_labels) + 1  # Fallback: sequential numbering
 
-        states = ["'" + state.text + "'" for state in character.findall("state")]
+        states = ["'" + (state.text or "") + "'" for state in character.findall("state")]
         label = f"{character_number} '{name}' / {' '.join(states)},"
 
         character_state_labels.append("\t\t" + label)
 
-    character_state_labels[-1] = character_state_labels[-1].replace(",", ";")
+    # A partial job may not have extracted any characters yet
+    if character_state_labels:
+        character_state_labels[-1] = character_state_labels[-1].replace(",", ";")
 
     return character_state_labels
\ No newline at end of file
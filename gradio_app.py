@@ -0,0 +1,327 @@
+import argparse
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from backend.apps.database.main import drop_job
+from backend.apps.doc.main import convert_document
+from backend.apps.langchain.main import cancel_job
+from backend.apps.pipeline.main import run_pipeline, build_nexus
+from backend.apps.retriever.main import MAX_CONTEXT_TOKENS
+from backend.apps.scheduler.main import JobBudget
+from backend.apps.utils.main import get_sanitized_filename
+
+# Jobs processed at once, and jobs allowed to wait for a free slot before uploads are refused
+MAX_CONCURRENT_JOBS = 4
+MAX_QUEUED_JOBS = 16
+
+# Finished jobs are kept this long for their results to be downloaded
+JOB_RETENTION_SECONDS = 3600
+
+# Upload size limit in bytes
+MAX_UPLOAD_SIZE = 100 * 1024 * 1024
+
+DEFAULT_MODEL = "gemini/gemini-1.5-flash"
+
+
+class Job:
+    """
+    Holds the state, progress events and result of one API job.
+    """
+
+    def __init__(self, process_name, budget):
+        self.id = uuid.uuid4().hex
+        self.process_name = process_name
+        self.budget = budget
+        self.status = "queued"
+        self.result = None
+        self.remaining_batches = None
+        self.nexus_content = ""
+        self.finished_at = None
+        self.events = []
+        self._condition = threading.Condition()
+
+    def emit(self, event, data):
+        with self._condition:
+            self.events.append((event, data))
+            self._condition.notify_all()
+
+    def finish(self, status):
+        self.status = status
+        self.finished_at = time.time()
+        self.emit("status", {"status": status})
+
+    def wait_for_events(self, seen, timeout):
+        """
+        Returns the events after the first `seen` ones, waiting up to timeout seconds for new ones.
+        """
+        with self._condition:
+            if len(self.events) <= seen and self.finished_at is None:
+                self._condition.wait(timeout)
+            return self.events[seen:]
+
+    def describe(self):
+        return {
+            "job_id": self.id,
+            "process_name": self.process_name,
+            "status": self.status,
+            "remaining_batches": self.remaining_batches,
+            "tokens_used": self.budget.tokens_used,
+            "cost": self.budget.cost,
+        }
+
+
+jobs = {}
+jobs_lock = threading.Lock()
+job_slots = threading.BoundedSemaphore(MAX_CONCURRENT_JOBS + MAX_QUEUED_JOBS)
+job_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS)
+
+
+def run_job(job, character_list, target_pages, num_characters, nexus_file, ai_model, max_context_tokens=MAX_CONTEXT_TOKENS):
+    try:
+        if job.budget.exhausted():
+            job.finish("cancelled")
+            return
+
+        job.status = "running"
+        job.emit("status", {"status": "running"})
+
+        raw_characters = convert_document(character_list, target_pages)
+        job.result, job.remaining_batches = run_pipeline(
+            job.process_name, raw_characters, num_characters, nexus_file, ai_model, budget=job.budget,
+            on_progress=lambda message: job.emit("message", {"message": message}),
+            on_batch=lambda batch: job.emit("batch", batch), max_context_tokens=max_context_tokens,
+        )
+        job.finish("cancelled" if job.budget.exhausted() == "cancelled" else "done")
+    except Exception as e:
+        job.emit("error", {"message": str(e)})
+        job.finish("failed")
+    finally:
+        # Don't leave requests of a failed job queued
+        cancel_job(job.process_name)
+        job_slots.release()
+
+
+def remove_expired_jobs():
+    with jobs_lock:
+        expired = [job for job in jobs.values() if job.finished_at is not None and time.time() - job.finished_at > JOB_RETENTION_SECONDS]
+        for job in expired:
+            del jobs[job.id]
+
+    # Each job has its own tables, which would otherwise pile up in the store
+    for job in expired:
+        drop_job(job.process_name)
+
+
+def parse_multipart(content_type, body):
+    """
+    Splits a multipart/form-data body into its fields.
+
+    Returns:
+        A dictionary mapping each field name to a tuple of its filename (or None) and its bytes.
+    """
+    message = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body)
+    if not message.is_multipart():
+        raise ValueError("Expected a multipart/form-data body.")
+
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if name:
+            fields[name] = (part.get_filename(), part.get_payload(decode=True) or b"")
+    return fields
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the job API:
+
+        POST   /jobs               upload 'character_list' and 'nexus_file', returns the job ID
+        GET    /jobs/<id>          job status
+        GET    /jobs/<id>/events   progress as server-sent events
+        GET    /jobs/<id>/result   the updated NEXUS file, or a partial one while the job runs
+        DELETE /jobs/<id>          cancel the job
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_job(self, job_id):
+        with jobs_lock:
+            job = jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {"error": "Unknown job."})
+        return job
+
+    def route(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if not parts or parts[0] != "jobs" or len(parts) > 3:
+            return None, None
+        return (parts[1] if len(parts) > 1 else None), (parts[2] if len(parts) > 2 else None)
+
+    def do_POST(self):
+        # Error responses sent before the body is read close the connection, as the
+        # unread body would otherwise be parsed as the next request
+        if self.path.split("?")[0].rstrip("/") != "/jobs":
+            self.close_connection = True
+            self.send_json(404, {"error": "Not found."}, headers={"Connection": "close"})
+            return
+
+        try:
+            length = int(self.headers["Content-Length"])
+            if length < 0:
+                raise ValueError(length)
+        except (TypeError, ValueError):
+            self.close_connection = True
+            self.send_json(400, {"error": "Missing or invalid Content-Length."}, headers={"Connection": "close"})
+            return
+        if length > MAX_UPLOAD_SIZE:
+            self.close_connection = True
+            self.send_json(413, {"error": "Upload too large."}, headers={"Connection": "close"})
+            return
+        body = self.rfile.read(length)
+
+        try:
+            fields = parse_multipart(self.headers.get("Content-Type", ""), body)
+            character_filename, character_bytes = fields["character_list"]
+            nexus_filename, nexus_bytes = fields["nexus_file"]
+            target_pages = fields["target_pages"][1].decode("utf-8")
+            num_characters = int(fields.get("num_characters", (None, b"0"))[1] or 0)
+            ai_model = fields.get("model", (None, DEFAULT_MODEL.encode()))[1].decode("utf-8")
+            time_limit = float(fields.get("time_limit", (None, b"0"))[1] or 0)
+            token_limit = int(fields.get("token_limit", (None, b"0"))[1] or 0)
+            cost_limit = float(fields.get("cost_limit", (None, b"0"))[1] or 0)
+            max_context_tokens = int(fields.get("max_context_tokens", (None, b"0"))[1] or MAX_CONTEXT_TOKENS)
+        except (KeyError, ValueError) as e:
+            self.send_json(400, {"error": f"Invalid upload: {e}"})
+            return
+
+        # Refuse new work instead of queueing without bound
+        if not job_slots.acquire(blocking=False):
+            self.send_json(503, {"error": "Too many jobs in progress."}, headers={"Retry-After": "30"})
+            return
+
+        remove_expired_jobs()
+
+        character_list = io.BytesIO(character_bytes)
+        character_list.name = character_filename or "character_list.pdf"
+        nexus_file = io.BytesIO(nexus_bytes)
+        nexus_file.name = nexus_filename or "matrix.nex"
+
+        filename, file_extension = os.path.splitext(character_list.name)
+        budget = JobBudget(deadline_seconds=time_limit * 60 or None, max_tokens=token_limit or None, max_cost=cost_limit or None)
+        job = Job(get_sanitized_filename(filename), budget)
+        # Concurrent jobs for the same file must not share a table
+        job.process_name = f"{job.process_name}_{job.id[:8]}"
+
+        job.nexus_content = nexus_bytes.decode("utf-8", errors="replace")
+
+        with jobs_lock:
+            jobs[job.id] = job
+        job_executor.submit(run_job, job, character_list, target_pages, num_characters, nexus_file, ai_model, max_context_tokens)
+
+        self.send_json(202, {"job_id": job.id}, headers={"Location": f"/jobs/{job.id}"})
+
+    def do_GET(self):
+        job_id, action = self.route()
+        if job_id is None:
+            self.send_json(404, {"error": "Not found."})
+            return
+
+        job = self.get_job(job_id)
+        if job is None:
+            return
+
+        if action is None:
+            self.send_json(200, job.describe())
+        elif action == "events":
+            self.stream_events(job)
+        elif action == "result":
+            result = job.result
+            if result is None and job.status == "running":
+                # Serve what has been extracted so far
+                try:
+                    _, result = build_nexus(job.process_name, job.nexus_content)
+                except Exception:
+                    result = None  # The job's tables aren't created yet
+            if result is None:
+                self.send_json(409, {"error": f"The job is {job.status}."})
+                return
+            body = result.encode("utf-8")
+            self.send_response(200)
+            self.send_header("X-Partial-Result", "false" if job.result is not None else "true")
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Disposition", f'attachment; filename="{job.process_name}.nex"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {"error": "Not found."})
+
+    def do_DELETE(self):
+        job_id, action = self.route()
+        if job_id is None or action is not None:
+            self.send_json(404, {"error": "Not found."})
+            return
+
+        job = self.get_job(job_id)
+        if job is None:
+            return
+
+        job.budget.cancel()
+        self.send_json(202, job.describe())
+
+    def stream_events(self, job):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        seen = int(self.headers.get("Last-Event-ID") or 0)
+        try:
+            while True:
+                events = job.wait_for_events(seen, timeout=15)
+                if not events:
+                    if job.finished_at is not None:
+                        break
+                    self.wfile.write(b": keep-alive\n\n")  # Keeps proxies from closing an idle stream
+                for event, data in events:
+                    seen += 1
+                    self.wfile.write(f"id: {seen}\nevent: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client went away, the job carries on
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the NEXUS file generator over HTTP.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), JobRequestHandler)
+    server.daemon_threads = True
+    print(f"Serving on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
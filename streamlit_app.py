@@ -2,51 +2,132 @@ import streamlit as st
 import os
 import time
 
-from backend.apps.database.main import identify_invalid_batches, initialize_database, update_database, read_database, get_labels
-
-from backend.apps.nex.main import insert_or_replace_charstatelabels
 from backend.apps.doc.main import convert_document
-from backend.apps.prompt.main import build_rag_prompt, build_evaluation_prompt
-from backend.apps.langchain.main import get_response, get_eval
+from backend.apps.langchain.main import cancel_job
+from backend.apps.pipeline.main import run_pipeline, run_multi_document_job, build_nexus
+from backend.apps.retriever.main import MAX_CONTEXT_TOKENS
+from backend.apps.scheduler.main import JobBudget
 from backend.apps.utils.main import get_sanitized_filename
-from backend.apps.xml.main import parse_xml, validate_xml, build_character_state_labels
 
 # Layout and file upload
 st.title("MorphoBank PBDB PDF to NEXUS File Generator")
 
 st.subheader("Start by Uploading the Document.")
 st.write("Upload the document containing your character list. For best results, have the file open alongside this app.")
-uploaded_character_list = st.file_uploader("Upload Character List file")
+several_documents = st.checkbox("Process several documents at once", help="Upload a character list and a NEXUS file with the same name for each paper.")
+if several_documents:
+    uploaded_character_lists = st.file_uploader("Upload Character List files", type=["pdf", "docx"], accept_multiple_files=True)
+    uploaded_character_list = None
+else:
+    uploaded_character_list = st.file_uploader("Upload Character List file", type=["pdf", "docx"])
 
 st.subheader("Define your Characters")
 st.write("Please identify the pages in the document where the character state labels are located? Also, please specify the number of characters and their corresponding states that you'd like me to extract")
 
-opt_col1, opt_col2 = st.columns(2)
-with opt_col1:
-    target_pages = st.text_input("On what pages are the character states located? (e.g., 3-4)", placeholder="3-4")
-with opt_col2:
-    num_characters = st.number_input("How many characters are there?", step=int(1))
+target_unit = "page"
+if uploaded_character_list is not None and uploaded_character_list.name.lower().endswith(".docx"):
+    target_unit = st.radio("Locate the characters in the Word document by:", ("page", "section"), horizontal=True)
+
+if several_documents:
+    # Each document takes its number of characters from the NCHAR of its NEXUS file
+    document_pages = {
+        character_list.name: st.text_input(f"On what pages of {character_list.name} are the character states located? (e.g., 3-4)", placeholder="3-4", key=f"pages_{character_list.name}")
+        for character_list in uploaded_character_lists
+    }
+else:
+    opt_col1, opt_col2 = st.columns(2)
+    with opt_col1:
+        target_pages = st.text_input(f"On what {target_unit}s are the character states located? (e.g., 3-4)", placeholder="3-4")
+    with opt_col2:
+        num_characters = st.number_input("How many characters are there? (0 uses NCHAR from the NEXUS file)", min_value=0, step=int(1))
 
 st.subheader("Select the inference model")
 st.write("Which model should I use to process your data?")
 selected_model = st.selectbox("Choose the Gemini model for inference:",("Gemini 1.5 Flash", "Gemini 1.5 Pro"))
 ai_model = {"Gemini 1.5 Flash": "gemini/gemini-1.5-flash", "Gemini 1.5 Pro": "gemini/gemini-1.5-pro"}[selected_model]
 
+st.subheader("Set the job limits")
+st.write("Processing stops once any limit is reached, and the characters extracted so far are added to the NEXUS file. Leave a limit at 0 to disable it.")
+
+limit_col1, limit_col2, limit_col3 = st.columns(3)
+with limit_col1:
+    time_limit = st.number_input("Time limit (minutes)", min_value=0, step=int(1))
+with limit_col2:
+    token_limit = st.number_input("Token budget", min_value=0, step=int(1000))
+with limit_col3:
+    cost_limit = st.number_input("Cost limit (USD)", min_value=0.0, step=0.5)
+
+max_context_tokens = st.number_input("Context size per batch (tokens)", min_value=500, value=MAX_CONTEXT_TOKENS, step=int(500))
+
 st.subheader("Upload the Empty NEXUS File")
 st.write("Please upload the Nexus file with the missing character state labels that need to be processed.")
-uploaded_nexus_file = st.file_uploader("Upload NEXUS File", type="nex")
+if several_documents:
+    uploaded_nexus_files = st.file_uploader("Upload NEXUS Files", type="nex", accept_multiple_files=True)
+else:
+    uploaded_nexus_file = st.file_uploader("Upload NEXUS File", type="nex")
 
+progress_view = st.empty()
+download_view = st.empty()
 character_state_view = st.empty()
 
 # Processing
 with st.sidebar:
-    if st.button("Process NEXUS file"):
+    if several_documents:
+        if st.button("Process NEXUS files"):
+
+            start_time = time.time()
+            budget = JobBudget(deadline_seconds=time_limit * 60 or None, max_tokens=token_limit or None, max_cost=cost_limit or None)
+
+            # Pair each character list with the NEXUS file of the same name
+            nexus_files = {os.path.splitext(nexus_file.name)[0]: nexus_file for nexus_file in uploaded_nexus_files}
+            documents = []
+            document_names = {}
+            for character_list in uploaded_character_lists:
+                filename, file_extension = os.path.splitext(character_list.name)
+                if filename not in nexus_files:
+                    st.warning(f"Skipping {character_list.name}, no {filename}.nex was uploaded.")
+                    continue
+                document_names[get_sanitized_filename(filename)] = filename
+                documents.append({
+                    "character_list": character_list,
+                    "target_pages": document_pages[character_list.name],
+                    "num_characters": 0,
+                    "nexus_file": nexus_files[filename],
+                    "budget": budget,
+                })
+
+            with st.status(f"Processing {len(documents)} documents...", expanded=True) as status:
+                # Each document's NEXUS file is offered as soon as it is done
+                results = run_multi_document_job(documents, ai_model)
+                try:
+                    for process_name, updated_nexus_file, remaining_batches, error in results:
+                        # Process names are the sanitized file name with a unique suffix
+                        document_name = document_names[process_name.rsplit("_", 1)[0]]
+                        if error is not None:
+                            st.error(f"{document_name} failed: {error}")
+                            continue
+                        if remaining_batches:
+                            st.warning(f"{document_name}: please review the following characters. {remaining_batches}")
+                        st.download_button(
+                            label=f"Download {document_name}.nex",
+                            data=updated_nexus_file,
+                            file_name=document_name + ".nex",
+                            key=f"nexus_{process_name}",
+                            on_click="ignore",
+                        )
+                finally:
+                    # Stop the remaining documents if the session stops or reruns mid-job
+                    budget.cancel()
+                    results.close()
+
+                status.update(label="Processing complete!", state="complete", expanded=True)
+
+            st.info(f"Finished in {round(time.time() - start_time, 1)} seconds")
+
+    elif st.button("Process NEXUS file"):
 
         start_time = time.time()
 
-        attempt = 0
-        max_attempts = 5
-
         filename, file_extension = os.path.splitext(uploaded_character_list.name)
 
         process_name = get_sanitized_filename(filename)
@@ -54,74 +135,50 @@ with st.sidebar:
         with st.status("Processing...", expanded=True) as status:
 
             st.write("Parsing Character List...")
-            raw_characters = convert_document(uploaded_character_list, target_pages)
-
-            #elif file_extension == ".docx" or ".doc":
-                #st.write("Parsing Docs...")
-                #raw_characterstatelabels = parse_docx(uploaded_character_list)4
-
-            initialize_database(process_name, raw_characters, num_characters)
-
-            while attempt < max_attempts:
-
-                batches = identify_invalid_batches(process_name)
-                if not batches:  # If batches is empty, break the loop
-                    break
-
-                try: 
-                    if attempt == 0: st.write("Preparing Data Batches...")
-                    elif attempt == 1 : st.write("Reattempting Failed Batches")
-
-                    context = read_database(process_name, batches, column_name="context")
-                    prompt = read_database(process_name, batches, column_name="prompt")
-
-                    if attempt == 0: 
-                        st.write("Querying Language Model...")
-                    rag_prompt = build_rag_prompt(context, prompt)
-                    response = get_response(rag_prompt, ai_model) 
-                    
-                    if attempt == 0: 
-                        st.write("Validating and Evaluating Response...")
-                    xml_characters = parse_xml(response)
-                    update_database(process_name, batches, xml_characters, column_name="xml_characters")
-                    
-                    validation_status = validate_xml(batches, xml_characters)
-                    update_database(process_name, batches, validation_status, column_name="validation_status")
-
-                    evaluation_prompt = build_evaluation_prompt(prompt, xml_characters, context)
-                    evaluation_status = get_eval(evaluation_prompt)
-                    update_database(process_name, batches, evaluation_status, column_name="evaluation_status")
-                
-                except Exception as e:
-                    st.write(f"Reattempting as it raised an internal error.")
-                    continue
-
-                attempt += 1
-
-            if attempt == max_attempts:
-                # Check if there are still invalid batches
-                remaining_batches = identify_invalid_batches(process_name)
-                if remaining_batches:
-                    st.write("Incomplete Characters Extracted...")
-                else:  
-                    st.write("Character Extraction Complete!")
-
-            characterstatelabels_xml = get_labels(process_name)
-
-            characterstatelabels = build_character_state_labels(characterstatelabels_xml)
-
-            st.write("Adding Characters to Nexus File...")
-            updated_nexus_file = insert_or_replace_charstatelabels(uploaded_nexus_file, characterstatelabels)
+            raw_characters = convert_document(uploaded_character_list, target_pages, target_unit)
+
+            nexus_content = uploaded_nexus_file.getvalue().decode('utf-8')
+            completed_this_run = 0
+
+            def show_batch(event):
+                global completed_this_run
+                completed_this_run += event["complete"]
+
+                # Throughput and ETA are based on the batches completed in this run
+                elapsed = time.time() - start_time
+                rate = completed_this_run / elapsed * 60
+                remaining = event["total_batches"] - event["completed_batches"]
+                eta = f"{remaining / rate * 60:.0f}s" if rate else "unknown"
+                progress_view.progress(
+                    event["completed_batches"] / max(1, event["total_batches"]),
+                    text=f"{event['completed_batches']}/{event['total_batches']} batches · {rate:.1f} batches/min · ETA {eta}",
+                )
+
+                labels, partial_nexus_file = build_nexus(process_name, nexus_content)
+                character_state_view.code("\n".join(labels), language=None)
+                download_view.download_button(
+                    label="Download partial NEXUS File",
+                    data=partial_nexus_file,
+                    file_name=process_name + "_partial.nex",
+                    key=f"partial_nexus_{time.time()}",
+                    on_click="ignore",
+                )
+
+            budget = JobBudget(deadline_seconds=time_limit * 60 or None, max_tokens=token_limit or None, max_cost=cost_limit or None)
+            try:
+                updated_nexus_file, remaining_batches = run_pipeline(process_name, raw_characters, num_characters, uploaded_nexus_file, ai_model, budget=budget, on_progress=st.write, on_batch=show_batch, max_context_tokens=max_context_tokens)
+            finally:
+                # Drop any queued requests if the session stops or reruns mid-job
+                budget.cancel()
+                cancel_job(process_name)
 
             end_time = time.time()
             total_time = str(round((end_time-start_time),1))
 
-            if attempt == max_attempts:
-                # Check if there are still invalid batches
-                remaining_batches = identify_invalid_batches(process_name)
-                if remaining_batches:
-                    status.update(label="Processing incomplete.", state="complete", expanded=True)
-                    character_state_view.warning(f"Please review the following characters. {remaining_batches}")
+            download_view.empty()
+            if remaining_batches:
+                status.update(label="Processing incomplete.", state="complete", expanded=True)
+                character_state_view.warning(f"Please review the following characters. {remaining_batches}")
             else:  
                 status.update(label="Processing complete! Your NEXUS file is ready.", state="complete", expanded=False)
 